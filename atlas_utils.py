@@ -0,0 +1,87 @@
+"""
+Atlas utils
+Tick name <-> node index lookups, cached per atlas, and bulk conversion
+between 'L2-R5' style edge names and index arrays.
+Every function takes an atlasobj or a plain list of tick names.
+"""
+import numpy as np
+
+_tickIndexCache = {}
+
+def _ticks_of(atlasobj):
+	return atlasobj.ticks if hasattr(atlasobj, 'ticks') else atlasobj
+
+def tick_index_map(atlasobj):
+	"""
+	The {tick: index} dict of the atlas. Built once per distinct tick list,
+	later calls get the cached dict.
+	A repeated tick maps to its first index, like list.index.
+	"""
+	key = tuple(_ticks_of(atlasobj))
+	if key not in _tickIndexCache:
+		tickIndex = {}
+		for idx, tick in enumerate(key):
+			tickIndex.setdefault(tick, idx)
+		_tickIndexCache[key] = tickIndex
+	return _tickIndexCache[key]
+
+def ticks_to_indexes(atlasobj, ticks):
+	"""
+	Node indexes of the given tick names as an int array.
+	Raises ValueError for a tick not in the atlas, like list.index.
+	"""
+	tickIndex = tick_index_map(atlasobj)
+	try:
+		return np.array([tickIndex[tick] for tick in ticks], dtype = int)
+	except KeyError as e:
+		raise ValueError('%s is not a tick of the atlas' % e.args[0])
+
+def indexes_to_ticks(atlasobj, indexes):
+	"""
+	Tick names of the given node indexes.
+	"""
+	ticks = _ticks_of(atlasobj)
+	return [ticks[idx] for idx in np.asarray(indexes, dtype = int).ravel()]
+
+def edge_names_to_indexes(atlasobj, edgeNames, sep = '-'):
+	"""
+	Convert edge names like ['L2-R5', ...] to xidx, yidx index arrays.
+	"""
+	pairs = [name.split(sep) for name in edgeNames]
+	xidx = ticks_to_indexes(atlasobj, [pair[0] for pair in pairs])
+	yidx = ticks_to_indexes(atlasobj, [pair[1] for pair in pairs])
+	return xidx, yidx
+
+def indexes_to_edge_names(atlasobj, xidx, yidx, sep = '-'):
+	"""
+	Convert xidx, yidx index arrays to edge names like ['L2-R5', ...].
+	"""
+	ticks = np.asarray(_ticks_of(atlasobj), dtype = str)
+	names = np.char.add(np.char.add(ticks[np.asarray(xidx, dtype = int)], sep), ticks[np.asarray(yidx, dtype = int)])
+	return names.tolist()
+
+def edge_matrix(atlasobj, xidx, yidx, values, symmetric = True, dtype = np.float64):
+	"""
+	An N x N matrix with values at (xidx, yidx), and at (yidx, xidx) too if symmetric.
+	All other entries are zero.
+	"""
+	ticks = _ticks_of(atlasobj)
+	mat = np.zeros((len(ticks), len(ticks)), dtype = dtype)
+	mat[xidx, yidx] = values
+	if symmetric:
+		mat[yidx, xidx] = values
+	return mat
+
+def edge_dict_to_matrix(atlasobj, edgeDict, symmetric = True, sep = '-'):
+	"""
+	Convert edgeDict = {'L2-R5': 0.345, ...} to an N x N matrix.
+	"""
+	xidx, yidx = edge_names_to_indexes(atlasobj, list(edgeDict.keys()), sep)
+	return edge_matrix(atlasobj, xidx, yidx, np.fromiter(edgeDict.values(), dtype = float, count = len(edgeDict)), symmetric)
+
+def sub_network_indexes(atlasobj, nodes):
+	"""
+	xidx, yidx of every ordered pair of the given nodes (auto-connections included).
+	"""
+	idx = ticks_to_indexes(atlasobj, nodes)
+	return np.repeat(idx, len(idx)), np.tile(idx, len(idx))
@@ -0,0 +1,231 @@
+"""
+Benchmarks of the loaders, stats and plotting utils on a synthetic cohort.
+Usage:
+	python benchmarks/run_benchmarks.py --subjects 20 --nodes 90 --output results.json
+	python benchmarks/run_benchmarks.py --filter stats --compare results.json
+Each benchmark is timed over --repeat runs, then run once more under
+tracemalloc for its peak Python/numpy memory. Results are written as json,
+and --compare prints the speedup against an earlier result file.
+Runs offline: if mmdps is not installed, the stand-in in benchmarks/standin is used.
+"""
+import os
+import sys
+import gc
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchDir)
+sys.path.insert(0, repoDir)
+sys.path.insert(0, benchDir)
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+def _use_standin(force):
+	if not force:
+		try:
+			import mmdps.proc, mmdps.util
+			return False
+		except ImportError:
+			pass
+	sys.path.insert(0, os.path.join(benchDir, 'standin'))
+	return True
+
+def measure(func, repeat):
+	"""
+	Time func over repeat runs, then record its peak traced memory in one more run.
+	An untimed warm-up call first takes the deferred imports and first-use costs
+	out of the timings. Output printed by func is swallowed.
+	"""
+	times = []
+	with contextlib.redirect_stdout(io.StringIO()):
+		func()
+		for run in range(repeat):
+			gc.collect()
+			start = time.perf_counter()
+			func()
+			times.append(time.perf_counter() - start)
+		gc.collect()
+		tracemalloc.start()
+		try:
+			func()
+			current, peak = tracemalloc.get_traced_memory()
+		finally:
+			tracemalloc.stop()
+	times.sort()
+	return {'times': times, 'min': times[0], 'median': statistics.median(times), 'peakBytes': peak}
+
+def define_benchmarks(tree, workDir, args):
+	"""
+	The (name, func) of every benchmark. Data they share is loaded here, once.
+	"""
+	import numpy as np
+	from matplotlib import pyplot as plt
+	from mmdps.proc import atlas
+	import io_utils, stats_utils, plot_utils, result_utils, dynamic_utils, atlas_utils, cache_utils
+
+	atlasobj = atlas.get(tree['atlasName'])
+	boldPath = tree['boldPath']
+	with contextlib.redirect_stdout(io.StringIO()):
+		index = io_utils.ScanIndex.build(boldPath)
+		netsA = io_utils.loadSpecificNets(index, atlasobj, 1, tree['groupA'])
+		netsB = io_utils.loadSpecificNets(index, atlasobj, 1, tree['groupB'])
+		cohortA = io_utils.loadSpecificNets(index, atlasobj, 1, tree['groupA'], asCohort = True)
+		cohortB = io_utils.loadSpecificNets(index, atlasobj, 1, tree['groupB'], asCohort = True)
+		secondTime = io_utils.loadSpecificNets(index, atlasobj, min(2, tree['times']), tree['groupA'])
+		warmCache = cache_utils.MatrixCache(os.path.join(workDir, 'warm_cache'))
+		io_utils.loadAllNets(index, atlasobj, cache = warmCache)
+	allNets = netsA + netsB
+	timeseries = np.random.default_rng(0).normal(size = (atlasobj.count, args.series_length))
+	dynamicDict = {'windowLength': tree['windowLength'], 'stepSize': tree['stepSize']}
+	xidx, yidx = np.triu_indices(atlasobj.count, 1)
+	edgeNames = atlas_utils.indexes_to_edge_names(atlasobj, xidx, yidx)
+	plotindexes = plot_utils.get_plot_indexes(atlasobj, atlasobj.ticks)
+	figureNets = allNets[:args.figures]
+
+	def temp_dir():
+		return tempfile.mkdtemp(dir = workDir)
+
+	def plot_heatmap_order():
+		fig = plot_utils.plot_heatmap_order(allNets[0].data, atlasobj.ticks, plotindexes, 'bench')
+		plt.close(fig)
+
+	benchmarks = [
+		('io.ScanIndex.build', lambda: io_utils.ScanIndex.build(boldPath)),
+		('io.loadAllNets', lambda: io_utils.loadAllNets(boldPath, atlasobj)),
+		('io.loadAllNets.workers', lambda: io_utils.loadAllNets(boldPath, atlasobj, workers = args.workers)),
+		('io.loadAllNets.cohort', lambda: io_utils.loadAllNets(boldPath, atlasobj, asCohort = True)),
+		('io.loadAllNets.cache_cold', lambda: io_utils.loadAllNets(boldPath, atlasobj, cache = cache_utils.MatrixCache(temp_dir()))),
+		('io.loadAllNets.cache_warm', lambda: io_utils.loadAllNets(boldPath, atlasobj, cache = warmCache)),
+		('io.loadSpecificNets', lambda: io_utils.loadSpecificNets(boldPath, atlasobj, 1)),
+		('io.loadAllTemporalNets', lambda: io_utils.loadAllTemporalNets(boldPath, tree['times'], atlasobj)),
+		('io.loadAllDynamicNets', lambda: io_utils.loadAllDynamicNets(boldPath, atlasobj, dynamicDict)),
+		('io.loadAllDynamicNets.cohort', lambda: io_utils.loadAllDynamicNets(boldPath, atlasobj, dynamicDict, asCohort = True)),
+		('io.loadAllDynamicNets.timeseries', lambda: io_utils.loadAllDynamicNets(boldPath, atlasobj, dynamicDict, fromTimeseries = True)),
+		('io.loadRandomDynamicNets', lambda: io_utils.loadRandomDynamicNets(boldPath, atlasobj, len(allNets), seed = 0)),
+		('io.loadAllEdgeValues.dynamic', lambda: io_utils.loadAllEdgeValues(index, atlasobj, xidx[:10], yidx[:10], dynamicIncluded = True)),
+		('io.save_matrices.csv', lambda: io_utils.save_matrices([net.data for net in allNets], temp_dir(), [net.name for net in allNets])),
+		('io.save_matrices.npy', lambda: io_utils.save_matrices([net.data for net in allNets], temp_dir(), [net.name for net in allNets], fileType = 'npy')),
+		('stats.edge_ttest', lambda: stats_utils.edge_ttest(netsA, netsB)),
+		('stats.filter_sigdiff_connections', lambda: stats_utils.filter_sigdiff_connections(netsA, netsB)),
+		('stats.filter_sigdiff_connections.cohort', lambda: stats_utils.filter_sigdiff_connections(cohortA, cohortB)),
+		('stats.filter_sigdiff_connections_Bonferroni', lambda: stats_utils.filter_sigdiff_connections_Bonferroni(netsA, netsB)),
+		('stats.filter_sigdiff_connections_FDR', lambda: stats_utils.filter_sigdiff_connections_FDR(netsA, netsB)),
+		('stats.sigdiff_connections_after_treatment', lambda: stats_utils.sigdiff_connections_after_treatment(netsA, secondTime)),
+		('stats.row_wise_ttest_groups', lambda: stats_utils.row_wise_ttest_groups(netsA, netsB)),
+		('stats.permutation_test_edges', lambda: stats_utils.permutation_test_edges(cohortA, cohortB, nPerm = args.permutations, seed = 0)),
+		('stats.network_based_statistic', lambda: stats_utils.network_based_statistic(cohortA, cohortB, nPerm = args.permutations, seed = 0)),
+		('stats.bootstrap_confidence_interval', lambda: stats_utils.bootstrap_confidence_interval(cohortA.edges, seed = 0)),
+		('stats.mean_confidence_interval', lambda: stats_utils.mean_confidence_interval(cohortA.edges, axis = 0)),
+		('dynamic.sliding_window_corrcoef', lambda: dynamic_utils.sliding_window_corrcoef(timeseries, tree['windowLength'], 1)),
+		('atlas.edge_names_to_indexes', lambda: atlas_utils.edge_names_to_indexes(atlasobj, edgeNames)),
+		('plot.reorder_matrix', lambda: plot_utils.reorder_matrix(cohortA.stack, plotindexes)),
+		('plot.plot_heatmap_order', plot_heatmap_order),
+		('result.render_net_heatmaps', lambda: result_utils.render_net_heatmaps(figureNets, [os.path.join(workDir, 'figures', '%s.png' % net.name) for net in figureNets], [net.name for net in figureNets], dpi = 50)),
+		('result.edge_histograms', lambda: result_utils.edge_histograms(cohortA)),
+		('result.screen_FCHist_overlap', lambda: result_utils.screen_FCHist_overlap({'A': cohortA, 'B': cohortB})),
+		('result.getAllFCAtTick.boldPath', lambda: result_utils.getAllFCAtTick(edgeNames[0].split('-')[0], edgeNames[0].split('-')[1], template_name = tree['atlasName'], boldPath = index)),
+	]
+	if len(tree['groupA']) >= 6 and not args.skip_classifier:
+		benchmarks.append(('stats.classify_sigdiff_connections', lambda: stats_utils.classify_sigdiff_connections(cohortA, cohortB, sigLevels = (0.01, 0.05), Cs = (1.0,), nFolds = 3, nInnerFolds = 2, seed = 0)))
+	return benchmarks
+
+def _git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = repoDir, capture_output = True, text = True, check = True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(results, previousFile):
+	"""
+	Print the median time of each benchmark against an earlier result file.
+	"""
+	with open(previousFile) as f:
+		previous = {result['name']: result for result in json.load(f)['results']}
+	print('%-45s %10s %10s %8s' % ('benchmark', 'before', 'now', 'speedup'))
+	for result in results:
+		before = previous.get(result['name'])
+		if before is None or 'median' not in before or 'median' not in result:
+			continue
+		print('%-45s %9.4fs %9.4fs %7.2fx' % (result['name'], before['median'], result['median'], before['median'] / max(result['median'], 1e-12)))
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = 'Benchmark the mmdps utils on a synthetic cohort.')
+	parser.add_argument('--subjects', type = int, default = 20)
+	parser.add_argument('--times', type = int, default = 2, help = 'scans per subject')
+	parser.add_argument('--nodes', type = int, default = 90, help = 'atlas size, ignored with the real mmdps atlases')
+	parser.add_argument('--atlas', default = None, help = 'atlas name, default synthetic_<nodes>')
+	parser.add_argument('--time-length', type = int, default = 200)
+	parser.add_argument('--window-length', type = int, default = 50)
+	parser.add_argument('--step-size', type = int, default = 25)
+	parser.add_argument('--series-length', type = int, default = 1200, help = 'time points of the sliding window benchmark')
+	parser.add_argument('--permutations', type = int, default = 200)
+	parser.add_argument('--figures', type = int, default = 4)
+	parser.add_argument('--workers', type = int, default = 4)
+	parser.add_argument('--repeat', type = int, default = 3)
+	parser.add_argument('--filter', default = None, help = 'only run benchmarks whose name contains this')
+	parser.add_argument('--skip-classifier', action = 'store_true')
+	parser.add_argument('--standin', action = 'store_true', help = 'use the mmdps stand-in even if mmdps is installed')
+	parser.add_argument('--workdir', default = None, help = 'where to write the synthetic tree, default a temp dir that is removed afterwards')
+	parser.add_argument('--output', default = 'benchmark_results.json')
+	parser.add_argument('--compare', default = None, help = 'an earlier result file to compare with')
+	args = parser.parse_args(argv)
+
+	standin = _use_standin(args.standin)
+	import numpy as np
+	from mmdps.proc import atlas
+	import synthetic
+
+	atlasName = args.atlas or 'synthetic_%d' % args.nodes
+	nodes = atlas.get(atlasName).count
+	workDir = args.workdir or tempfile.mkdtemp(prefix = 'mmdps_bench_')
+	try:
+		start = time.perf_counter()
+		tree = synthetic.make_bold_tree(os.path.join(workDir, 'bold'), atlasName, nodes, args.subjects, args.times, args.time_length, args.window_length, args.step_size)
+		print('Synthetic tree of %d scans, %d nodes written in %1.2fs.' % (len(tree['scans']), nodes, time.perf_counter() - start))
+		benchmarks = define_benchmarks(tree, workDir, args)
+		results = []
+		for name, func in benchmarks:
+			if args.filter and args.filter not in name:
+				continue
+			result = {'name': name}
+			try:
+				result.update(measure(func, args.repeat))
+				print('%-45s %9.4fs  peak %8.1f MiB' % (name, result['median'], result['peakBytes'] / 2**20))
+			except Exception as e:
+				result['error'] = '%s: %s' % (type(e).__name__, e)
+				print('%-45s failed, %s' % (name, result['error']))
+			results.append(result)
+	finally:
+		if args.workdir is None:
+			shutil.rmtree(workDir, ignore_errors = True)
+
+	output = {
+		'config': vars(args),
+		'environment': {
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'platform': platform.platform(),
+			'cpuCount': os.cpu_count(),
+			'commit': _git_commit(),
+			'mmdpsStandin': standin,
+		},
+		'results': results,
+	}
+	with open(args.output, 'w') as f:
+		json.dump(output, f, indent = 1)
+	print('Results written to %s' % args.output)
+	if args.compare:
+		compare(results, args.compare)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,4 @@
+"""
+A lightweight stand-in for the parts of mmdps the utils use, so the
+benchmarks run offline. Only put on sys.path when mmdps is not installed.
+"""
@@ -0,0 +1,33 @@
+"""
+Stand-in atlases. get('synthetic_90') gives a 90 node atlas with ticks
+L1..L45, R1..R45 interleaved, plotted left hemisphere first.
+"""
+import re
+
+class Atlas:
+	def __init__(self, name, count):
+		self.name = name
+		self.count = count
+		half = (count + 1) // 2
+		self.ticks = [('L%d' if idx % 2 == 0 else 'R%d') % (idx // 2 + 1) for idx in range(count)]
+		# left ticks first, then right
+		self.plotindexes = list(range(0, count, 2)) + list(range(1, count, 2))
+		self._plotPosition = {tickIdx: pos for pos, tickIdx in enumerate(self.plotindexes)}
+		self._tickIndex = {tick: idx for idx, tick in enumerate(self.ticks)}
+
+	def ticks_to_plot_indexes(self, ticks):
+		return [self._plotPosition[self._tickIndex[tick]] for tick in ticks]
+
+_atlases = {}
+
+def register(name, count):
+	_atlases[name] = Atlas(name, count)
+	return _atlases[name]
+
+def get(name):
+	if name not in _atlases:
+		match = re.search(r'(\d+)$', name)
+		if match is None:
+			raise ValueError('Unknown atlas %s, register it first' % name)
+		register(name, int(match.group(1)))
+	return _atlases[name]
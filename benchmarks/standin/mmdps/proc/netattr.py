@@ -0,0 +1,29 @@
+"""
+Stand-in for mmdps.proc.netattr.Net.
+"""
+import numpy as np
+
+class Net:
+	def __init__(self, data, atlasobj, name = 'Net'):
+		self.data = data
+		self.atlasobj = atlasobj
+		self.name = name
+
+	@property
+	def net(self):
+		return self.data
+
+	@property
+	def template(self):
+		return self.atlasobj
+
+	@property
+	def ticks(self):
+		return self.atlasobj.ticks
+
+	def get_value_at_idx(self, xidx, yidx):
+		return self.data[xidx, yidx]
+
+	def get_all_connection_values(self):
+		xidx, yidx = np.triu_indices(self.data.shape[0], 1)
+		return self.data[xidx, yidx]
@@ -0,0 +1,10 @@
+"""
+Stand-in for mmdps.util.loadsave.
+"""
+import numpy as np
+
+def load_csvmat(filePath):
+	return np.loadtxt(filePath, delimiter = ',')
+
+def save_csvmat(filePath, mat):
+	np.savetxt(filePath, mat, delimiter = ',')
@@ -0,0 +1,64 @@
+"""
+Synthetic boldPath trees for the benchmarks.
+The layout is the one the loaders expect:
+	<subject>_<time>/<atlas>/bold_net/corrcoef.csv
+	<subject>_<time>/<atlas>/bold_net/timeseries.csv
+	<subject>_<time>/<atlas>/bold_net/<start>-<end>.csv (dynamic windows)
+	<subject>_<time>/<atlas>/bold_net.csv (the same as corrcoef.csv, read by loadSpecificNets)
+"""
+import os
+import numpy as np
+
+def _timeseries(rng, nodes, timeLength, effect):
+	"""
+	Regions x time points from a few shared latent signals plus noise.
+	effect strengthens the coupling of the first tenth of the regions.
+	"""
+	latent = rng.normal(size = (4, timeLength))
+	mixing = rng.normal(scale = 0.5, size = (nodes, 4))
+	block = max(2, nodes // 10)
+	mixing[:block, 0] += effect
+	return mixing @ latent + rng.normal(size = (nodes, timeLength))
+
+def _save_csv(filePath, mat):
+	np.savetxt(filePath, mat, delimiter = ',')
+
+def make_bold_tree(root, atlasName, nodes, subjects = 20, times = 2, timeLength = 200, windowLength = 50, stepSize = 25, effect = 0.8, seed = 0):
+	"""
+	Write a synthetic boldPath tree to root.
+	The first half of the subjects is group A, the others are group B,
+	whose first regions are more strongly coupled. Each subject has times scans.
+	windowLength = 0 writes no dynamic windows.
+	Returns a dict with the scans, the subjects of both groups and the tree settings.
+	"""
+	rng = np.random.default_rng(seed)
+	subjectNames = ['subj%03d' % idx for idx in range(subjects)]
+	groupA = subjectNames[:subjects // 2]
+	groupB = subjectNames[subjects // 2:]
+	scans = []
+	for subjectName in subjectNames:
+		for timeIdx in range(times):
+			scan = '%s_2018%02d01' % (subjectName, timeIdx + 1)
+			scans.append(scan)
+			folder = os.path.join(root, scan, atlasName, 'bold_net')
+			os.makedirs(folder, exist_ok = True)
+			ts = _timeseries(rng, nodes, timeLength, effect if subjectName in groupB else 0.0)
+			_save_csv(os.path.join(folder, 'timeseries.csv'), ts)
+			_save_csv(os.path.join(folder, 'corrcoef.csv'), np.corrcoef(ts))
+			_save_csv(os.path.join(root, scan, atlasName, 'bold_net.csv'), np.corrcoef(ts))
+			if windowLength <= 0:
+				continue
+			for start in range(0, timeLength - windowLength + 1, stepSize):
+				_save_csv(os.path.join(folder, '%d-%d.csv' % (start, start + windowLength)), np.corrcoef(ts[:, start:start + windowLength]))
+	return {
+		'boldPath': root,
+		'atlasName': atlasName,
+		'nodes': nodes,
+		'scans': scans,
+		'groupA': groupA,
+		'groupB': groupB,
+		'times': times,
+		'timeLength': timeLength,
+		'windowLength': windowLength,
+		'stepSize': stepSize,
+	}
@@ -0,0 +1,169 @@
+"""
+Cache utils
+A binary cache for the csv connectome matrices, so that the text files
+are parsed only once. Entries are .npy files that are read back memory-mapped.
+"""
+import os
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+class MatrixCache:
+	"""
+	A directory of .npy files, one per source csv matrix (or per cohort stack).
+	An entry is keyed by the absolute source path, its mtime and size and the
+	atlas name, so a changed source file or another atlas never hits a stale entry.
+	Entries are written to a temp file and renamed into place, so several
+	processes can share the cache directory. Every hit touches the entry,
+	and when the cache grows over maxBytes the least recently used entries are removed.
+	"""
+	def __init__(self, cacheDir, maxBytes = None, mmap = True):
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		self.mmap = mmap
+		os.makedirs(cacheDir, exist_ok = True)
+		self._sizeEstimate = None
+
+	def _source_id(self, path):
+		stat = os.stat(path)
+		return '%s|%d|%d' % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+	def _entry_path(self, keyString):
+		return os.path.join(self.cacheDir, hashlib.sha1(keyString.encode('utf-8')).hexdigest() + '.npy')
+
+	def entry_path(self, path, atlasName):
+		"""
+		The cache file for one source matrix. Raises FileNotFoundError if the source is missing.
+		"""
+		return self._entry_path('%s|%s' % (self._source_id(path), atlasName))
+
+	def _read(self, entryPath):
+		try:
+			mat = np.load(entryPath, mmap_mode = 'r' if self.mmap else None)
+		except (FileNotFoundError, ValueError, OSError):
+			# missing, evicted meanwhile or half-written by a crashed process
+			return None
+		try:
+			os.utime(entryPath)
+		except OSError:
+			pass
+		return mat
+
+	def _write(self, entryPath, mat):
+		fd, tmpPath = tempfile.mkstemp(dir = self.cacheDir, suffix = '.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				np.save(f, np.asarray(mat))
+			os.replace(tmpPath, entryPath)
+		except BaseException:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+		if self.maxBytes is not None:
+			if self._sizeEstimate is None:
+				self._sizeEstimate = self.size()
+			else:
+				self._sizeEstimate += os.path.getsize(entryPath)
+			if self._sizeEstimate > self.maxBytes:
+				self.evict(keep = entryPath)
+
+	def get(self, path, atlasName):
+		"""
+		Return the cached matrix of the source csv, or None.
+		"""
+		return self._read(self.entry_path(path, atlasName))
+
+	def put(self, path, atlasName, mat):
+		self._write(self.entry_path(path, atlasName), mat)
+
+	def load(self, path, atlasName, loader):
+		"""
+		Return the matrix of the source csv from the cache, or load it with
+		loader(path) and store it. Returns (mat, hit).
+		"""
+		entryPath = self.entry_path(path, atlasName)
+		mat = self._read(entryPath)
+		if mat is not None:
+			return mat, True
+		mat = loader(path)
+		self._write(entryPath, mat)
+		if self.mmap:
+			cached = self._read(entryPath)
+			if cached is not None:
+				mat = cached
+		return mat, False
+
+	def stack_entry_path(self, paths, atlasName, tag = ''):
+		"""
+		The cache file for a whole cohort stack of the given source files.
+		Raises FileNotFoundError if any source is missing.
+		"""
+		return self._entry_path('%s|%s|%s' % ('\n'.join(self._source_id(path) for path in paths), atlasName, tag))
+
+	def get_stack(self, paths, atlasName, tag = ''):
+		return self._read(self.stack_entry_path(paths, atlasName, tag))
+
+	def put_stack(self, paths, atlasName, stack, tag = ''):
+		entryPath = self.stack_entry_path(paths, atlasName, tag)
+		self._write(entryPath, stack)
+		if self.mmap:
+			cached = self._read(entryPath)
+			if cached is not None:
+				return cached
+		# evicted meanwhile by another process
+		return stack
+
+	def _entries(self):
+		ret = []
+		for entry in os.scandir(self.cacheDir):
+			try:
+				stat = entry.stat()
+			except FileNotFoundError:
+				continue
+			ret.append((entry.path, entry.name, stat))
+		return ret
+
+	def size(self):
+		"""
+		Total bytes of the cache entries.
+		"""
+		return sum(stat.st_size for path, name, stat in self._entries() if name.endswith('.npy'))
+
+	def evict(self, maxBytes = None, keep = None):
+		"""
+		Remove the least recently used entries until the cache fits in maxBytes.
+		The entry at path keep is never removed, so a new entry larger than
+		maxBytes survives its own write.
+		Also removes temp files left over by crashed writers.
+		"""
+		if maxBytes is None:
+			maxBytes = self.maxBytes
+		entries = []
+		total = 0
+		now = time.time()
+		for path, name, stat in self._entries():
+			if name.endswith('.tmp') and now - stat.st_mtime > 3600:
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					pass
+			elif name.endswith('.npy'):
+				entries.append((stat.st_mtime, stat.st_size, path))
+				total += stat.st_size
+		entries.sort()
+		for mtime, size, path in entries:
+			if maxBytes is None or total <= maxBytes:
+				break
+			if path == keep:
+				continue
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				# removed by another process
+				pass
+			total -= size
+		self._sizeEstimate = total
+
+	def clear(self):
+		self.evict(0)
@@ -0,0 +1,188 @@
+"""
+Cohort utils
+A cohort keeps the connectomes of many scans in one stacked array
+instead of a list of netattr.Net objects.
+"""
+import numpy as np
+
+import lazy_utils
+
+netattr = lazy_utils.lazy_import('mmdps.proc.netattr')
+
+def split_scan_name(scan):
+	"""
+	Split a scan folder name like 'subject_20180101' into subject name and time string.
+	"""
+	if scan.find('_') != -1:
+		return scan[:scan.find('_')], scan[scan.find('_')+1:]
+	return scan, ''
+
+class NetCohort:
+	"""
+	A cohort of connectomes of the same atlas.
+	The data are stored as one contiguous (scans, N, N) array, or as a
+	(scans, N*(N-1)/2) array of the upper-triangle connections if packed.
+	Packed storage does not keep the diagonal (auto-connections), it is
+	zero in the unpacked matrices.
+	Each scan carries its scan name, subject name and time string, and for
+	dynamic nets the (start, end) of its window.
+	Iterating the cohort or indexing it with an int gives netattr.Net views
+	of the stacked data (copied only if packed).
+	"""
+	def __init__(self, data, atlasobj, scans = None, subjects = None, times = None, windows = None, packed = False):
+		self.data = data
+		self.atlasobj = atlasobj
+		self.packed = packed
+		self.count = atlasobj.count
+		if scans is None:
+			scans = ['%d' % idx for idx in range(data.shape[0])]
+		self.scans = list(scans)
+		if subjects is None:
+			subjects = [split_scan_name(scan)[0] for scan in self.scans]
+		self.subjects = list(subjects)
+		if times is None:
+			times = [split_scan_name(scan)[1] for scan in self.scans]
+		self.times = list(times)
+		self.windows = None if windows is None else list(windows)
+		self._triu = np.triu_indices(self.count, 1)
+
+	@classmethod
+	def from_mats(cls, mats, atlasobj, scans = None, total = None, dtype = np.float64, packed = False, **kwargs):
+		"""
+		Build a cohort from an iterable of N x N matrices.
+		If total (the max number of matrices) is given, the stacked array is
+		allocated once and filled as the matrices come in, so the matrices
+		can be produced lazily without keeping a second copy of each.
+		"""
+		if total is None:
+			mats = list(mats)
+			total = len(mats)
+		n = atlasobj.count
+		if packed:
+			xidx, yidx = np.triu_indices(n, 1)
+			data = np.empty((total, len(xidx)), dtype = dtype)
+		else:
+			data = np.empty((total, n, n), dtype = dtype)
+		filled = 0
+		for mat in mats:
+			if packed:
+				data[filled] = mat[xidx, yidx]
+			else:
+				data[filled] = mat
+			filled += 1
+		if filled < total:
+			data = data[:filled]
+		return cls(data, atlasobj, scans = scans, packed = packed, **kwargs)
+
+	@classmethod
+	def from_nets(cls, nets, scans = None, dtype = np.float64, packed = False):
+		"""
+		Build a cohort from a list of netattr.Net. Net names are used as scan names if no scans given.
+		"""
+		if scans is None:
+			scans = [net.name for net in nets]
+		return cls.from_mats([net.data for net in nets], nets[0].atlasobj, scans = scans, total = len(nets), dtype = dtype, packed = packed)
+
+	def __len__(self):
+		return self.data.shape[0]
+
+	def __iter__(self):
+		for idx in range(len(self)):
+			yield self.net(idx)
+
+	def __getitem__(self, key):
+		"""
+		cohort[int] gives a Net view of one scan.
+		cohort[scanName] gives the Net of that scan.
+		cohort[slice / list of ints / bool array / list of scan names] gives a sub-cohort.
+		"""
+		if isinstance(key, (int, np.integer)):
+			return self.net(key)
+		if isinstance(key, str):
+			return self.net(self.scans.index(key))
+		if isinstance(key, slice):
+			idx = np.arange(len(self))[key]
+		elif len(key) > 0 and isinstance(key[0], str):
+			scanIdx = {scan: idx for idx, scan in enumerate(self.scans)}
+			idx = np.array([scanIdx[scan] for scan in key], dtype = int)
+		else:
+			idx = np.asarray(key)
+			if idx.dtype == bool:
+				idx = np.flatnonzero(idx)
+		return self._subset(idx)
+
+	def _subset(self, idx):
+		return NetCohort(self.data[idx], self.atlasobj,
+			scans = [self.scans[i] for i in idx],
+			subjects = [self.subjects[i] for i in idx],
+			times = [self.times[i] for i in idx],
+			windows = None if self.windows is None else [self.windows[i] for i in idx],
+			packed = self.packed)
+
+	def net(self, idx):
+		"""
+		Return a netattr.Net of the idx-th scan. The Net shares memory with the cohort unless packed.
+		"""
+		return netattr.Net(self.matrix(idx), self.atlasobj, name = self.scans[idx])
+
+	def matrix(self, idx):
+		"""
+		Return the N x N matrix of the idx-th scan.
+		"""
+		if not self.packed:
+			return self.data[idx]
+		mat = np.zeros((self.count, self.count), dtype = self.data.dtype)
+		mat[self._triu] = self.data[idx]
+		mat.T[self._triu] = self.data[idx]
+		return mat
+
+	def subject(self, subjectName):
+		"""
+		Return a sub-cohort with all scans of the given subject, in time order.
+		"""
+		return self._subset(np.array([idx for idx, name in enumerate(self.subjects) if name == subjectName], dtype = int))
+
+	def select_subjects(self, subjectList):
+		"""
+		Return a sub-cohort with all scans of the subjects in subjectList.
+		"""
+		subjectSet = set(subjectList)
+		return self._subset(np.array([idx for idx, name in enumerate(self.subjects) if name in subjectSet], dtype = int))
+
+	@property
+	def stack(self):
+		"""
+		The (scans, N, N) array. Unpacked into a new array if packed.
+		"""
+		if not self.packed:
+			return self.data
+		return np.stack([self.matrix(idx) for idx in range(len(self))])
+
+	@property
+	def edges(self):
+		"""
+		The (scans, N*(N-1)/2) array of upper-triangle connections.
+		"""
+		if self.packed:
+			return self.data
+		return self.data[:, self._triu[0], self._triu[1]]
+
+	def edge_index(self, xidx, yidx):
+		"""
+		Position of connection (xidx, yidx) in the packed upper-triangle order.
+		xidx and yidx may be arrays.
+		"""
+		xidx, yidx = np.minimum(xidx, yidx), np.maximum(xidx, yidx)
+		return xidx * self.count - xidx * (xidx + 1) // 2 + yidx - xidx - 1
+
+	def edge(self, xidx, yidx):
+		"""
+		Values of connection (xidx, yidx) for all scans.
+		If xidx and yidx are arrays of length K, a (scans, K) array is returned.
+		"""
+		if self.packed:
+			return self.data[:, self.edge_index(np.asarray(xidx), np.asarray(yidx))]
+		return self.data[:, xidx, yidx]
+
+	def astype(self, dtype):
+		return NetCohort(self.data.astype(dtype), self.atlasobj, scans = self.scans, subjects = self.subjects, times = self.times, windows = self.windows, packed = self.packed)
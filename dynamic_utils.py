@@ -0,0 +1,90 @@
+"""
+Dynamic utils
+Sliding-window functional connectivity computed straight from the timeseries,
+instead of reading one precomputed csv per window.
+"""
+import numpy as np
+
+def window_starts(timeLength, windowLength, stepSize = 1):
+	"""
+	Start time points of all full windows.
+	"""
+	return np.arange(0, timeLength - windowLength + 1, stepSize)
+
+def window_names(timeLength, windowLength, stepSize = 1):
+	"""
+	The 'a-b' names of the windows, as used for the dynamic net files.
+	"""
+	return ['%d-%d' % (start, start + windowLength) for start in window_starts(timeLength, windowLength, stepSize)]
+
+def _batched_windows(ts, starts, windowLength, out, batchSize):
+	"""
+	Each window computed on its own, batchSize windows per matrix product.
+	The windows are z-scored first, so the product is the correlation itself.
+	"""
+	windows = np.lib.stride_tricks.sliding_window_view(ts, windowLength, axis = 1)
+	for first in range(0, len(starts), batchSize):
+		batch = windows[:, starts[first:first + batchSize], :].transpose(1, 0, 2)
+		batch = batch - batch.mean(axis = 2, keepdims = True)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			batch /= np.sqrt(np.einsum('wnl,wnl->wn', batch, batch))[:, :, np.newaxis]
+		if out.dtype == batch.dtype:
+			np.matmul(batch, batch.transpose(0, 2, 1), out = out[first:first + batchSize])
+		else:
+			out[first:first + batchSize] = np.matmul(batch, batch.transpose(0, 2, 1))
+		np.clip(out[first:first + batchSize], -1, 1, out = out[first:first + batchSize])
+
+def _incremental_windows(ts, starts, windowLength, stepSize, out, resync):
+	"""
+	Keep running sums of x and x x^T and only add the time points that enter
+	and remove those that leave the window. The sums are recomputed every
+	resync windows so rounding errors do not build up.
+	"""
+	n = ts.shape[0]
+	# centering the whole series keeps s2 - s1 s1^T / L well conditioned
+	ts = ts - ts.mean(axis = 1, keepdims = True)
+	cov = np.empty((n, n))
+	for idx, start in enumerate(starts):
+		if idx % resync == 0:
+			seg = ts[:, start:start + windowLength]
+			s1 = seg.sum(axis = 1)
+			s2 = seg @ seg.T
+		else:
+			leaving = ts[:, start - stepSize:start]
+			entering = ts[:, start + windowLength - stepSize:start + windowLength]
+			s1 += entering.sum(axis = 1) - leaving.sum(axis = 1)
+			# x x^T of the entering minus the leaving time points in one product
+			s2 += np.hstack([entering, leaving]) @ np.hstack([entering, -leaving]).T
+		np.subtract(s2, np.multiply.outer(s1, s1 / windowLength), out = cov)
+		# a constant region gives NaN rows, as in the batched path, without warnings
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			scale = 1 / np.sqrt(np.diagonal(cov))
+			np.multiply(cov, scale[:, np.newaxis], out = cov)
+			np.multiply(cov, scale[np.newaxis, :], out = out[idx])
+		np.clip(out[idx], -1, 1, out = out[idx])
+
+def sliding_window_corrcoef(timeseries, windowLength, stepSize = 1, timeAxis = 1, dtype = np.float64, batchSize = 64, resync = 32):
+	"""
+	Compute the correlation matrix of every sliding window of the timeseries.
+	timeseries: regions x time points (timeAxis = 1), like timeseries.csv
+	Window k covers time points [k * stepSize, k * stepSize + windowLength),
+	the same as the precomputed 'a-b.csv' dynamic nets.
+	Returns a (windows, N, N) array, equal to np.corrcoef of each window.
+	Long, heavily overlapping windows (windowLength >= 100 * stepSize) are
+	updated incrementally, others are computed in batches of batchSize windows.
+	For shorter windows the matrix products are cheaper than the extra passes
+	over the N x N sums the incremental update needs.
+	"""
+	ts = np.asarray(timeseries, dtype = np.float64)
+	if timeAxis == 0:
+		ts = ts.T
+	n, timeLength = ts.shape
+	starts = window_starts(timeLength, windowLength, stepSize)
+	out = np.empty((len(starts), n, n), dtype = dtype)
+	if len(starts) == 0:
+		return out
+	if windowLength >= 100 * stepSize:
+		_incremental_windows(ts, starts, windowLength, stepSize, out, resync)
+	else:
+		_batched_windows(ts, starts, windowLength, out, batchSize)
+	return out
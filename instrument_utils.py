@@ -0,0 +1,186 @@
+"""
+Instrument utils
+Opt-in timing and counter events from the hot paths of io_utils, stats_utils,
+plot_utils and result_utils: files listed and read, bytes parsed, t-tests
+performed, figures rendered.
+Instrumentation is off by default, then every hook is a single flag check.
+Turn it on with one or more sinks, each called with every event dict:
+	collector = instrument_utils.MemorySink()
+	instrument_utils.enable(collector, instrument_utils.JsonLinesSink('events.jsonl'))
+	...
+	print(collector.summary())
+or set MMDPS_UTILS_INSTRUMENT=log (log the events) or MMDPS_UTILS_INSTRUMENT=/path/events.jsonl.
+An event has the keys event (its name), kind ('timer' or 'counter'), time
+(unix time), duration (seconds, timers) or value (counters), plus the fields
+given by the hook.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import functools
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+_sinks = []
+
+class LoggingSink:
+	"""
+	Log each event as one line, at level to logger.
+	"""
+	def __init__(self, logger = logger, level = logging.INFO):
+		self.logger = logger
+		self.level = level
+
+	def __call__(self, event):
+		if self.logger.isEnabledFor(self.level):
+			self.logger.log(self.level, json.dumps(event, default = str))
+
+class JsonLinesSink:
+	"""
+	Append each event as one json line to filePath.
+	"""
+	def __init__(self, filePath, mode = 'a'):
+		self.filePath = filePath
+		self._file = open(filePath, mode)
+		self._lock = threading.Lock()
+
+	def __call__(self, event):
+		line = json.dumps(event, default = str) + '\n'
+		with self._lock:
+			self._file.write(line)
+			self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+class MemorySink:
+	"""
+	Keep the events in a list, e.g. for a summary at the end of a run or in tests.
+	"""
+	def __init__(self):
+		self.events = []
+
+	def __call__(self, event):
+		self.events.append(event)
+
+	def clear(self):
+		self.events = []
+
+	def summary(self):
+		"""
+		{event name: {'count', 'duration', 'value'}}, the number of events
+		and the summed duration (timers) and value (counters) per name.
+		"""
+		ret = {}
+		for event in self.events:
+			entry = ret.setdefault(event['event'], {'count': 0, 'duration': 0.0, 'value': 0})
+			entry['count'] += 1
+			entry['duration'] += event.get('duration', 0.0)
+			entry['value'] += event.get('value', 0)
+		return ret
+
+def enable(*sinks):
+	"""
+	Turn instrumentation on and add the sinks (a LoggingSink if none given).
+	"""
+	global enabled
+	if len(sinks) == 0:
+		sinks = (LoggingSink(),)
+	_sinks.extend(sinks)
+	enabled = True
+
+def disable():
+	"""
+	Turn instrumentation off and remove all sinks. JsonLinesSinks are closed.
+	"""
+	global enabled
+	enabled = False
+	for sink in _sinks:
+		if isinstance(sink, JsonLinesSink):
+			sink.close()
+	del _sinks[:]
+
+def emit(name, kind, **fields):
+	if not enabled:
+		return
+	event = {'event': name, 'kind': kind, 'time': time.time()}
+	event.update(fields)
+	for sink in _sinks:
+		try:
+			sink(event)
+		except Exception:
+			logger.exception('Instrumentation sink %r failed', sink)
+
+def count(name, value = 1, **fields):
+	"""
+	Emit a counter event, e.g. count('stats.tests', 4005).
+	"""
+	if enabled:
+		emit(name, 'counter', value = value, **fields)
+
+class _Timer:
+	def __init__(self, name, fields):
+		self.name = name
+		self.fields = fields
+
+	def set(self, **fields):
+		"""
+		Add fields known only inside the timed block.
+		"""
+		self.fields.update(fields)
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		if excType is not None:
+			self.fields['error'] = excType.__name__
+		emit(self.name, 'timer', duration = time.perf_counter() - self.start, **self.fields)
+		return False
+
+class _NullTimer:
+	def set(self, **fields):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		return False
+
+_nullTimer = _NullTimer()
+
+def timer(name, **fields):
+	"""
+	Time a block:
+		with instrument_utils.timer('io.list_scans', boldPath = boldPath) as t:
+			...
+			t.set(scans = len(scans))
+	"""
+	if not enabled:
+		return _nullTimer
+	return _Timer(name, fields)
+
+def timed(name):
+	"""
+	Decorator that times every call of a function as event name.
+	"""
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return func(*args, **kwargs)
+			with _Timer(name, {}):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+_envSink = os.environ.get('MMDPS_UTILS_INSTRUMENT', '')
+if _envSink == 'log':
+	enable(LoggingSink())
+elif _envSink:
+	enable(JsonLinesSink(_envSink))
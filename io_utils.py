@@ -1,21 +1,100 @@
 import shutil
 import os
+import numpy as np
 import gzip
 import random
+import time
+import collections
+import concurrent.futures
+import json
+import itertools
+import queue
+import tempfile
+import threading
+import logging
 
-from mmdps.proc import netattr, atlas
-from mmdps.util import loadsave
+import cohort_utils
+import dynamic_utils
+import instrument_utils
+import lazy_utils
 
-def ungzip(fgz):
-	with gzip.open(fgz, 'rb') as fin,\
-		 open(fgz[:-3], 'wb') as fout:
-		shutil.copyfileobj(fin, fout)
+netattr = lazy_utils.lazy_import('mmdps.proc.netattr')
+atlas = lazy_utils.lazy_import('mmdps.proc.atlas')
+loadsave = lazy_utils.lazy_import('mmdps.util.loadsave')
 
-def process_subject_list(subjectList):
+logger = logging.getLogger(__name__)
+
+def ungzip(fgz, bufferSize = 16 * 2**20, skipUpToDate = False):
+	"""
+	Decompress fgz next to it, without the .gz suffix. Returns the output path.
+	The data are copied in chunks of bufferSize bytes into a temp file that is
+	renamed into place, so a crash never leaves a truncated output.
+	skipUpToDate: do nothing if the output exists and is not older than fgz
+	"""
+	fout = fgz[:-3]
+	if skipUpToDate and _is_up_to_date(fgz, fout):
+		return fout
+	fd, tmpPath = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(fout)), prefix = '.' + os.path.basename(fout), suffix = '.tmp')
+	try:
+		with gzip.open(fgz, 'rb') as fin, os.fdopen(fd, 'wb') as ftmp:
+			shutil.copyfileobj(fin, ftmp, bufferSize)
+		# mkstemp creates the file private, give it the permissions of the archive
+		shutil.copymode(fgz, tmpPath)
+		os.replace(tmpPath, fout)
+	except BaseException:
+		if os.path.exists(tmpPath):
+			os.remove(tmpPath)
+		raise
+	return fout
+
+def _is_up_to_date(fgz, fout):
+	try:
+		return os.path.getmtime(fout) >= os.path.getmtime(fgz)
+	except FileNotFoundError:
+		return False
+
+def ungzip_tree(rootDir, workers = 4, bufferSize = 16 * 2**20, skipUpToDate = True, suffixes = None):
+	"""
+	Decompress every .gz file under rootDir with a pool of workers threads
+	(zlib releases the GIL while decompressing).
+	suffixes: only files ending with one of these, e.g. ('.nii.gz', '.csv.gz')
+	Returns the lists of decompressed and skipped (up to date) outputs.
+	"""
+	todo = []
+	skipped = []
+	for dirPath, dirNames, fileNames in os.walk(rootDir):
+		for fileName in sorted(fileNames):
+			if not fileName.endswith('.gz'):
+				continue
+			if suffixes is not None and not fileName.endswith(tuple(suffixes)):
+				continue
+			fgz = os.path.join(dirPath, fileName)
+			if skipUpToDate and _is_up_to_date(fgz, fgz[:-3]):
+				skipped.append(fgz[:-3])
+			else:
+				todo.append(fgz)
+	with instrument_utils.timer('io.ungzip_tree', rootDir = rootDir, files = len(todo), skipped = len(skipped)):
+		with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+			done = list(executor.map(lambda fgz: ungzip(fgz, bufferSize), todo))
+	return done, skipped
+
+def load_gz(fgz, loader = None, mode = 'rt'):
+	"""
+	Hand the decompressed stream of fgz straight to loader(fileobj),
+	without writing the expanded file to disk.
+	The default loader is loadsave.load_csvmat, for .csv.gz matrices.
+	"""
+	if loader is None:
+		loader = loadsave.load_csvmat
+	with gzip.open(fgz, mode) as f:
+		return loader(f)
+
+def process_subject_list(subjectList, asSet = False):
 	"""
 	This helper function decides whether the input list is a string
 	It reads in names from the file specified by the string
 	or just returns if the argument is already a list
+	Use asSet = True to get a set for fast membership checks.
 	"""
 	ret = None
 	if type(subjectList) is str:
@@ -24,79 +103,454 @@ def process_subject_list(subjectList):
 		with open(subjectList) as f:
 			for line in f.readlines():
 				ret.append(line.strip())
-	elif type(subjectList) is list:
+	elif type(subjectList) in (list, tuple, set, frozenset):
 		ret = subjectList
+	if asSet and ret is not None:
+		ret = set(ret)
 	return ret
 
-def loadAllTemporalNets(boldPath, totalTimeCase, atlasobj, subjectList = None, specificTime = None):
+class ScanIndex:
+	"""
+	An index of the scans in boldPath, so that the folders are listed only once.
+	boldPath contains <subject>_<time>/<atlas>/bold_net/ folders.
+	The index records subject -> sorted scans (sessions), the atlases of each scan,
+	and the files in each bold_net folder (corrcoef.csv, timeseries.csv and the
+	dynamic a-b.csv windows). The atlas and bold_net folders are listed on first
+	use unless build() walked the whole tree. The index can be saved as json and
+	loaded in later runs; it is not refreshed when boldPath changes.
+	All loaders accept a ScanIndex in place of boldPath.
+	"""
+	def __init__(self, boldPath, scans = None):
+		self.boldPath = boldPath
+		if scans is None:
+			with instrument_utils.timer('io.list_scans', boldPath = boldPath) as t:
+				scans = sorted(entry.name for entry in os.scandir(boldPath) if entry.is_dir())
+				t.set(scans = len(scans))
+		self.scans = scans
+		self.subjects = collections.OrderedDict()
+		self.subjectOfScan = {}
+		for scan in scans:
+			subjectName = cohort_utils.split_scan_name(scan)[0]
+			self.subjects.setdefault(subjectName, []).append(scan)
+			self.subjectOfScan[scan] = subjectName
+		self._atlases = {}
+		self._boldNetFiles = {}
+
+	@classmethod
+	def build(cls, boldPath, atlasNames = None):
+		"""
+		Walk the whole tree at once. Limit to some atlases with atlasNames.
+		"""
+		index = cls(boldPath)
+		for scan in index.scans:
+			for atlasName in index.atlases(scan):
+				if atlasNames is None or atlasName in atlasNames:
+					index.bold_net_files(scan, atlasName)
+		return index
+
+	def atlases(self, scan):
+		"""
+		The sorted atlas folders of a scan.
+		"""
+		if scan not in self._atlases:
+			self._atlases[scan] = sorted(entry.name for entry in os.scandir(os.path.join(self.boldPath, scan)) if entry.is_dir())
+		return self._atlases[scan]
+
+	def sessions(self, subjectName):
+		return self.subjects.get(subjectName, [])
+
+	def bold_net_files(self, scan, atlasName):
+		"""
+		The sorted file names in <scan>/<atlas>/bold_net.
+		Raises FileNotFoundError if the folder does not exist.
+		"""
+		key = '%s/%s' % (scan, atlasName)
+		if key not in self._boldNetFiles:
+			try:
+				self._boldNetFiles[key] = sorted(entry.name for entry in os.scandir(self.bold_net_path(scan, atlasName)))
+			except FileNotFoundError:
+				self._boldNetFiles[key] = None
+			instrument_utils.count('io.folders_listed')
+		if self._boldNetFiles[key] is None:
+			raise FileNotFoundError('%s not found.' % self.bold_net_path(scan, atlasName))
+		return self._boldNetFiles[key]
+
+	def dynamic_files(self, scan, atlasName):
+		"""
+		The sorted dynamic window files (a-b.csv) of a scan.
+		"""
+		return [file for file in self.bold_net_files(scan, atlasName) if file.find('-') != -1]
+
+	def bold_net_path(self, scan, atlasName, file = None):
+		if file is None:
+			return os.path.join(self.boldPath, scan, atlasName, 'bold_net')
+		return os.path.join(self.boldPath, scan, atlasName, 'bold_net', file)
+
+	def scan_path(self, scan, *parts):
+		return os.path.join(self.boldPath, scan, *parts)
+
+	def save(self, filePath):
+		with open(filePath, 'w') as f:
+			json.dump({'boldPath': self.boldPath, 'scans': self.scans,
+				'atlases': self._atlases, 'boldNetFiles': self._boldNetFiles}, f)
+
+	@classmethod
+	def load(cls, filePath):
+		with open(filePath) as f:
+			d = json.load(f)
+		index = cls(d['boldPath'], d['scans'])
+		index._atlases = d['atlases']
+		index._boldNetFiles = d['boldNetFiles']
+		return index
+
+def get_scan_index(boldPath):
+	"""
+	Return boldPath if it is already a ScanIndex, otherwise index the folder.
+	"""
+	if isinstance(boldPath, ScanIndex):
+		return boldPath
+	return ScanIndex(boldPath)
+
+def _load_mat(path, timed = False, cache = None, atlasName = None):
+	"""
+	Load one csv matrix. Returns (mat, error, timing).
+	Runs in the worker threads/processes of _iter_mats, so errors are returned
+	instead of raised and reported in order by the caller.
+	If timed is 'split', the raw file is read first to time the I/O on its own, then the
+	parse time is taken from loadsave.load_csvmat on the now cached file.
+	If timed is 'total', only the single load_csvmat call is timed (as loadTime)
+	and the bytes are taken from os.stat, so the file is read once as usual.
+	With a cache_utils.MatrixCache, the matrix is read from the cache if possible.
+	A cache hit is timed as readTime of the .npy entry, a miss times the csv
+	parse as parseTime and reports the csv size as bytes.
+	"""
+	timing = None
+	try:
+		if cache is not None:
+			parseTimes = []
+			def timed_loader(csvPath):
+				start = time.perf_counter()
+				ret = loadsave.load_csvmat(csvPath)
+				parseTimes.append(time.perf_counter() - start)
+				return ret
+			start = time.perf_counter()
+			mat, hit = cache.load(path, atlasName, timed_loader if timed else loadsave.load_csvmat)
+			totalTime = time.perf_counter() - start
+			if timed and hit:
+				timing = {'path': path, 'bytes': mat.nbytes, 'readTime': totalTime, 'parseTime': 0.0, 'cached': True}
+			elif timed:
+				# a miss parses the csv, the rest is writing and mapping the cache entry
+				timing = {'path': path, 'bytes': os.stat(path).st_size, 'readTime': totalTime - parseTimes[0], 'parseTime': parseTimes[0], 'cached': False}
+		elif timed == 'total':
+			start = time.perf_counter()
+			mat = loadsave.load_csvmat(path)
+			loadTime = time.perf_counter() - start
+			timing = {'path': path, 'bytes': os.stat(path).st_size, 'loadTime': loadTime}
+		elif timed:
+			start = time.perf_counter()
+			with open(path, 'rb') as f:
+				nbytes = len(f.read())
+			readTime = time.perf_counter() - start
+			start = time.perf_counter()
+			mat = loadsave.load_csvmat(path)
+			timing = {'path': path, 'bytes': nbytes, 'readTime': readTime, 'parseTime': time.perf_counter() - start}
+		else:
+			mat = loadsave.load_csvmat(path)
+	except FileNotFoundError as e:
+		return None, e, timing
+	return mat, None, timing
+
+def _iter_mats(scans, paths, workers = None, pool = 'thread', timings = None, cache = None, atlasName = None):
+	"""
+	Load the matrix at each path, yields (scan, mat) in the given order.
+	Missing files are reported and skipped.
+	workers: number of threads/processes to load with. None or 1 loads serially.
+		At most 2 * workers files are in flight, so memory stays bounded
+		when the consumer is slower than the loading.
+	pool: 'thread' or 'process'
+	timings: a list to append one dict per file to, with keys
+		scan, path, bytes, readTime and parseTime (seconds)
+	cache: a cache_utils.MatrixCache to read the matrices from, atlasName is part of its key
+	With instrumentation on, each file emits an io.load_csvmat event with its
+	load time (split in read and parse times if timings is given), and the
+	totals are counted as io.files_read and io.bytes_parsed.
+	"""
+	instrumented = instrument_utils.enabled
+	if timings is not None:
+		timed = 'split'
+	elif instrumented:
+		timed = 'total'
+	else:
+		timed = False
+	filesRead = 0
+	bytesParsed = 0
+	if workers is None or workers <= 1:
+		results = (_load_mat(path, timed, cache, atlasName) for path in paths)
+		executor = None
+	else:
+		if pool == 'process':
+			executor = concurrent.futures.ProcessPoolExecutor(max_workers = workers)
+		else:
+			executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+		results = _bounded_map(executor, _load_mat, paths, (timed, cache, atlasName), 2 * workers)
+	try:
+		for scan, path, (mat, error, timing) in zip(scans, paths, results):
+			if timing is not None:
+				timing['scan'] = scan
+				if timings is not None:
+					timings.append(timing)
+				if instrumented:
+					duration = timing['loadTime'] if 'loadTime' in timing else timing['readTime'] + timing['parseTime']
+					instrument_utils.emit('io.load_csvmat', 'timer', duration = duration, **timing)
+					filesRead += 1
+					bytesParsed += timing['bytes']
+			if error is not None:
+				logger.warning('File %s not found. %s', path, error)
+				instrument_utils.count('io.files_missing', path = path)
+				continue
+			yield scan, mat
+	finally:
+		if executor is not None:
+			executor.shutdown(cancel_futures = True)
+		if instrumented:
+			instrument_utils.count('io.files_read', filesRead)
+			instrument_utils.count('io.bytes_parsed', bytesParsed)
+
+def _bounded_map(executor, func, paths, args, maxPending):
+	"""
+	Like executor.map, but only keeps maxPending tasks submitted ahead of the consumer.
+	"""
+	pending = collections.deque()
+	for path in paths:
+		if len(pending) >= maxPending:
+			yield pending.popleft().result()
+		pending.append(executor.submit(func, path, *args))
+	while pending:
+		yield pending.popleft().result()
+
+def summarize_load_timings(timings):
+	"""
+	Sum up the per-file timings collected by the loaders.
+	If the read time dominates, loading is I/O-bound and more workers help,
+	if the parse time dominates, use pool = 'process' or the binary cache.
+	Files read from a cache_utils.MatrixCache are left out of these numbers
+	and summed up under 'cacheHits' instead (files, bytes, readTime, readMBps).
+	"""
+	hits = [t for t in timings if t.get('cached')]
+	timings = [t for t in timings if not t.get('cached')]
+	totalRead = sum(t['readTime'] for t in timings)
+	totalParse = sum(t['parseTime'] for t in timings)
+	totalBytes = sum(t['bytes'] for t in timings)
+	hitRead = sum(t['readTime'] for t in hits)
+	hitBytes = sum(t['bytes'] for t in hits)
+	return {'files': len(timings),
+		'bytes': totalBytes,
+		'readTime': totalRead,
+		'parseTime': totalParse,
+		'readMBps': totalBytes / 1e6 / totalRead if totalRead > 0 else float('inf'),
+		'parseMBps': totalBytes / 1e6 / totalParse if totalParse > 0 else float('inf'),
+		'cacheHits': {'files': len(hits),
+			'bytes': hitBytes,
+			'readTime': hitRead,
+			'readMBps': hitBytes / 1e6 / hitRead if hitRead > 0 else float('inf')}}
+
+def _load(scans, paths, atlasobj, asCohort, workers = None, pool = 'thread', timings = None, cache = None):
+	"""
+	Load the matrices at paths into a list of netattr.Net, or into
+	a cohort_utils.NetCohort if asCohort is True or a dict of arguments
+	for NetCohort.from_mats (dtype, packed).
+	With a cache, a cohort is stored and read back as one memory-mapped stack.
+	"""
+	if asCohort and cache is not None:
+		return _load_cached_cohort(scans, paths, atlasobj, asCohort, workers, pool, timings, cache)
+	loaded = _iter_mats(scans, paths, workers, pool, timings, cache, atlasobj.name)
+	if not asCohort:
+		return [netattr.Net(mat, atlasobj) for scan, mat in loaded]
+	return _make_cohort(loaded, atlasobj, asCohort, len(scans))
+
+def _split_labels(labels):
+	"""
+	Dynamic nets are labelled (scan, window), static nets by the scan only.
+	Returns scans, windows (None for static nets).
+	"""
+	if len(labels) > 0 and isinstance(labels[0], tuple):
+		return [label[0] for label in labels], [label[1] for label in labels]
+	return labels, None
+
+def _make_cohort(loaded, atlasobj, asCohort, total):
+	cohortArgs = asCohort if isinstance(asCohort, dict) else {}
+	labels = []
+	def mats():
+		for label, mat in loaded:
+			labels.append(label)
+			yield mat
+	cohort = cohort_utils.NetCohort.from_mats(mats(), atlasobj, total = total, **cohortArgs)
+	# labels is filled in while from_mats consumes the matrices
+	scans, windows = _split_labels(labels)
+	return cohort_utils.NetCohort(cohort.data, atlasobj, scans = scans, windows = windows, packed = cohort.packed)
+
+def _load_cached_cohort(scans, paths, atlasobj, asCohort, workers, pool, timings, cache):
+	cohortArgs = asCohort if isinstance(asCohort, dict) else {}
+	existing = []
+	for idx, path in enumerate(paths):
+		if os.path.isfile(path):
+			existing.append(idx)
+		else:
+			logger.warning('File %s not found.', path)
+			instrument_utils.count('io.files_missing', path = path)
+	scans = [scans[idx] for idx in existing]
+	paths = [paths[idx] for idx in existing]
+	tag = '%s|%s' % (np.dtype(cohortArgs.get('dtype', np.float64)).str, cohortArgs.get('packed', False))
+	stack = cache.get_stack(paths, atlasobj.name, tag)
+	if stack is None:
+		# the single matrices are not cached, the stack replaces them
+		cohort = _make_cohort(_iter_mats(scans, paths, workers, pool, timings), atlasobj, asCohort, len(scans))
+		stack = cache.put_stack(paths, atlasobj.name, cohort.data, tag)
+	scans, windows = _split_labels(scans)
+	return cohort_utils.NetCohort(stack, atlasobj, scans = scans, windows = windows, packed = cohortArgs.get('packed', False))
+
+def loadAllTemporalNets(boldPath, totalTimeCase, atlasobj, subjectList = None, specificTime = None, asCohort = False, workers = None, pool = 'thread', timings = None, cache = None):
 	"""
 	This function is used to load temporal scans. All person with up
 	to totalTimeCase number of scans will be loaded and returned in a dict. 
 	The key of the dict is the subject name.
+	A subject with a missing scan is left out with a warning.
 	Each element in the dict is the temporal scans of one person. The data are stored
 	as a list of BrainNet.
 	Parameters:
+		- boldPath: the folder of scans, or a ScanIndex of it
 		- subjectList: a list of strs or a path to a text file
 		- specificTime: a dict, with key = subject name, value = [timeStr1, timeStr2, ...]
 				The length of value should equal to totalTimeCase
+		- asCohort: return all loaded scans in one cohort_utils.NetCohort instead,
+				use cohort.subject(name) to get the temporal scans of one person
+		- workers, pool, timings: load in parallel and time each file, see _iter_mats
+		- cache: a cache_utils.MatrixCache to read the parsed matrices from, see loadAllNets
 	"""
-	subjectList = process_subject_list(subjectList)
+	subjectList = process_subject_list(subjectList, asSet = True)
+	index = get_scan_index(boldPath)
+	scans = []
+	for subjectName, personScans in index.subjects.items():
+		if subjectList is not None and subjectName not in subjectList:
+			continue
+		if len(personScans) < totalTimeCase:
+			continue
+		if specificTime is not None and subjectName in specificTime:
+			personTime = [cohort_utils.split_scan_name(scan)[1] for scan in personScans]
+			scans += [personScans[personTime.index(timeStr)] for timeStr in specificTime[subjectName]]
+		else:
+			scans += personScans[:totalTimeCase]
+	paths = [index.bold_net_path(scan, atlasobj.name, 'corrcoef.csv') for scan in scans]
+	expected = collections.Counter(index.subjectOfScan[scan] for scan in scans)
+	if asCohort:
+		cohort = _load(scans, paths, atlasobj, asCohort, workers, pool, timings, cache)
+		complete = _complete_subjects(collections.Counter(cohort.subjects), expected)
+		if len(complete) < len(set(cohort.subjects)):
+			cohort = cohort.select_subjects(complete)
+		return cohort
 	ret = {}
-	currentPersonScans = []
-	currentPersonTime = []
-	subjectName = 'None'
-	lastSubjectName = 'Unknown'
-	occurrenceCounter = 0
-	for scan in sorted(os.listdir(boldPath)):
-		subjectName = scan[:scan.find('_')]
-		if subjectName != lastSubjectName:
-			if occurrenceCounter >= totalTimeCase:
-				if specificTime is not None and lastSubjectName in specificTime:
-					ret[lastSubjectName] = [currentPersonScans[currentPersonTime.index(timeStr)] for timeStr in specificTime[lastSubjectName]]
-				else:
-					ret[lastSubjectName] = currentPersonScans[:totalTimeCase]
-			occurrenceCounter = 0
-			lastSubjectName = subjectName
-			currentPersonScans = []
-			currentPersonTime = []
+	loaded = _iter_mats(scans, paths, workers, pool, timings, cache, atlasobj.name)
+	for scan, mat in loaded:
+		ret.setdefault(index.subjectOfScan[scan], []).append(netattr.Net(mat, atlasobj))
+	complete = set(_complete_subjects(collections.Counter({name: len(nets) for name, nets in ret.items()}), expected))
+	return {name: nets for name, nets in ret.items() if name in complete}
+
+def _complete_subjects(loaded, expected):
+	"""
+	The subjects whose scans were all loaded. Subjects with a missing
+	scan are reported and left out, so every subject keeps its full set of time points.
+	"""
+	complete = []
+	for subjectName, count in loaded.items():
+		if count == expected[subjectName]:
+			complete.append(subjectName)
+		else:
+			logger.warning('Subject %s dropped, only %d of its %d scans could be loaded.', subjectName, count, expected[subjectName])
+	return complete
+
+def _select_time_case(index, timeCase, subjectList):
+	"""
+	Return the sorted scans that are the timeCase-th scan of their subject.
+	"""
+	ret = []
+	for subjectName, personScans in index.subjects.items():
 		if subjectList is not None and subjectName not in subjectList:
 			continue
-		occurrenceCounter += 1
-		currentPersonScans.append(netattr.Net(loadsave.load_csvmat(os.path.join(boldPath, scan, atlasobj.name, 'bold_net', 'corrcoef.csv')), atlasobj))
-		currentPersonTime.append(scan[scan.find('_')+1:])
+		if len(personScans) >= timeCase:
+			ret.append(personScans[timeCase - 1])
 	return ret
 
-def loadSpecificNets(boldPath, atlasobj, timeCase = 1, subjectList = None):
+def loadSpecificNets(boldPath, atlasobj, timeCase = 1, subjectList = None, asCohort = False, workers = None, pool = 'thread', timings = None, cache = None):
 	"""
 	This function is an implementation on the new mmdps version.
 	This function is used to load the first/second/etc scans of subjects.
 	Specify which subjects to load as a list of strings or a file path in subjectList.
 	If no subjectList is given, load all scans.
+	workers, pool, timings, cache: load in parallel, time each file and cache, see loadAllNets.
 	"""
-	subjectList = process_subject_list(subjectList)
-	ret = []
-	subjectName = 'None'
-	lastSubjectName = 'Unknown'
-	for scan in sorted(os.listdir(boldPath)):
-		if scan.find('_') != -1:
-			subjectName = scan[:scan.find('_')]
-		else:
-			subjectName = scan
-		if subjectName != lastSubjectName:
-			occurrenceCounter = 0
-			lastSubjectName = subjectName
-		occurrenceCounter += 1
-		if subjectList is not None and subjectName not in subjectList:
+	subjectList = process_subject_list(subjectList, asSet = True)
+	index = get_scan_index(boldPath)
+	scans = _select_time_case(index, timeCase, subjectList)
+	paths = [index.scan_path(scan, atlasobj.name, 'bold_net.csv') for scan in scans]
+	return _load(scans, paths, atlasobj, asCohort, workers, pool, timings, cache)
+
+def iterRandomDynamicNets(boldPath, atlasobj, totalNum = 0, scanList = None, seed = None, workers = None, pool = 'thread', cache = None, dynamicDict = None, fromTimeseries = False):
+	"""
+	Generator version of loadRandomDynamicNets. Yields (scanName, net) one at a time,
+	so large random training sets need not be held in memory.
+	The dynamic windows of each scan are shuffled once, round k takes the k-th
+	window of every scan that still has one, so no window is picked twice and
+	each picked file is read exactly once.
+	Use seed for a reproducible draw. workers, pool and cache work as in loadAllNets.
+	dynamicDict limits the windows to one windowLength/stepSize, see _dynamic_windows.
+	fromTimeseries: compute the picked windows from timeseries.csv of each scan
+		instead of reading the window files, dynamicDict must give windowLength.
+		The timeseries of the scans are kept in memory while drawing.
+	"""
+	scanList = process_subject_list(scanList, asSet = True)
+	index = get_scan_index(boldPath)
+	rng = random.Random(seed)
+	permutations = collections.OrderedDict()
+	timeseries = {}
+	for scanName in index.scans:
+		if scanList is not None and scanName not in scanList:
 			continue
-		if occurrenceCounter == timeCase:
-			try:
-				ret.append(netattr.Net(loadsave.load_csvmat(os.path.join(boldPath, scan, atlasobj.name, 'bold_net.csv')), atlasobj))
-			except FileNotFoundError as e:
-				print('File %s not found.' % os.path.join(boldPath, scan, atlasobj.name, 'bold_net.csv'))
-				print(e)
-	return ret
+		try:
+			if fromTimeseries:
+				timeseries[scanName] = _load_timeseries(index, scanName, atlasobj)
+				dynamicList = dynamic_utils.window_names(timeseries[scanName].shape[1], dynamicDict['windowLength'], dynamicDict.get('stepSize', 1))
+				dynamicList = [name + '.csv' for name in dynamicList]
+			else:
+				dynamicList = [file for file, window in _dynamic_windows(index, scanName, atlasobj.name, dynamicDict)]
+		except FileNotFoundError as e:
+			logger.warning('File %s not found. %s', index.bold_net_path(scanName, atlasobj.name, 'corrcoef.csv'), e)
+			continue
+		permutations[scanName] = rng.sample(dynamicList, len(dynamicList))
+	picked = 0
+	roundIdx = 0
+	while picked < totalNum:
+		currentList = [(scanName, dynamicList[roundIdx]) for scanName, dynamicList in permutations.items() if roundIdx < len(dynamicList)]
+		if len(currentList) == 0:
+			logger.warning('Only %d dynamic nets available, %d requested.', picked, totalNum)
+			return
+		roundIdx += 1
+		# check if we add all these people in, the total amount would exceed
+		if len(currentList) > totalNum - picked:
+			# only add some people in
+			rng.shuffle(currentList)
+			currentList = currentList[:(totalNum - picked)]
+		if fromTimeseries:
+			for scanName, file in currentList:
+				start, end = parse_window_name(file)
+				picked += 1
+				yield scanName, netattr.Net(dynamic_utils.sliding_window_corrcoef(timeseries[scanName][:, start:end], end - start)[0], atlasobj, name = file)
+			continue
+		paths = [index.bold_net_path(scanName, atlasobj.name, file) for scanName, file in currentList]
+		for (scanName, file), mat in _iter_mats(currentList, paths, workers, pool, None, cache, atlasobj.name):
+			picked += 1
+			yield scanName, netattr.Net(mat, atlasobj, name = file)
 
-def loadRandomDynamicNets(boldPath, atlasobj, totalNum = 0, scanList = None):
+def loadRandomDynamicNets(boldPath, atlasobj, totalNum = 0, scanList = None, asCohort = False, seed = None, workers = None, pool = 'thread', cache = None, dynamicDict = None, fromTimeseries = False):
 	"""
 	This function is used to randomly load the dynamic nets of subjects.
 	Specify how many nets in total you would like to get in totalNum.
@@ -104,119 +558,326 @@ def loadRandomDynamicNets(boldPath, atlasobj, totalNum = 0, scanList = None):
 	Logic: Randomly load one dynamic net for each scan (make sure not repeat) and add it.
 		   If the total number is enough, return.
 		   If not, continue load one more dynamic net.
+	The nets are named after their window file. Use seed for a reproducible draw,
+	and iterRandomDynamicNets to stream the nets instead.
+	With asCohort, the cohort scans are the scan names of the windows.
+	dynamicDict and fromTimeseries: see iterRandomDynamicNets.
 	"""
-	retList = []
-	scanList = process_subject_list(scanList)
-	ret = {}
-	scanName = 'None'
-	lastScanName = 'Unknown'
-	iterationCounter = 0 # counter for total iteration, equals num of dynamic nets of each scan in ret
-	while len(retList) < totalNum:
-		iterationCounter += 1
-		currentList = []
-		for scanName in sorted(os.listdir(boldPath)):
-			if scanName != lastScanName:
-				occurrenceCounter = 0
-				lastScanName = scanName
-			occurrenceCounter += 1
-			if scanList is not None and scanName not in scanList:
-				continue
-			# randomly load one dynamic net in this subject
-			if scanName not in ret:
-					ret[scanName] = []
-			else:
-				pass
-			try:
-				# randomly search for one non-in net
-				dynamicList = sorted(os.listdir(os.path.join(boldPath, scanName, atlasobj.name, 'bold_net')))
-				dynamicList.remove('corrcoef.csv')
-				dynamicList.remove('timeseries.csv')
-				flag = True
-				while flag:
-					flag = False
-					# get a random
-					idx = random.randint(0, len(dynamicList)-1)
-					for net in ret[scanName]:
-						if net.name == dynamicList[idx]:
-							flag = True
-							break
-				ret[scanName].append(netattr.Net(loadsave.load_csvmat(os.path.join(boldPath, scanName, atlasobj.name, 'bold_net', dynamicList[idx])), atlasobj, name = dynamicList[idx]))
-				currentList.append(netattr.Net(loadsave.load_csvmat(os.path.join(boldPath, scanName, atlasobj.name, 'bold_net', dynamicList[idx])), atlasobj, name = dynamicList[idx]))
-			except FileNotFoundError as e:
-				print('File %s not found.' % os.path.join(boldPath, scanName, atlasobj.name, 'bold_net', 'corrcoef.csv'))
-				print(e)
-		# check if we add all these people in, the total amount would exceed
-		if len(currentList) + len(retList) > totalNum:
-			# only add some people in
-			random.shuffle(currentList)
-			retList += currentList[:(totalNum - len(retList))]
+	loaded = iterRandomDynamicNets(boldPath, atlasobj, totalNum, scanList, seed, workers, pool, cache, dynamicDict, fromTimeseries)
+	if asCohort:
+		return _make_cohort(((scanName, net.data) for scanName, net in loaded), atlasobj, asCohort, totalNum)
+	return [net for scanName, net in loaded]
+
+def parse_window_name(file):
+	"""
+	Parse a dynamic net file name 'a-b.csv' into its window (a, b).
+	Returns None if the name is not of this form.
+	"""
+	parts = os.path.splitext(file)[0].split('-')
+	if len(parts) != 2:
+		return None
+	try:
+		return int(parts[0]), int(parts[1])
+	except ValueError:
+		return None
+
+def _dynamic_windows(index, scan, atlasName, dynamicDict):
+	"""
+	The (file, window) of the dynamic nets of one scan, sorted by window start.
+	If dynamicDict gives windowLength, only windows with end - start == windowLength are kept.
+	If it gives stepSize, only windows starting stepSize apart from the first one are kept.
+	Raises FileNotFoundError if the bold_net folder is missing.
+	"""
+	files = index.dynamic_files(scan, atlasName)
+	windowLength = dynamicDict.get('windowLength') if dynamicDict else None
+	stepSize = dynamicDict.get('stepSize') if dynamicDict else None
+	ret = [(file, parse_window_name(file)) for file in files]
+	if windowLength is None and stepSize is None:
+		if all(window is not None for file, window in ret):
+			ret.sort(key = lambda x: x[1])
+		return ret
+	ret = sorted((x for x in ret if x[1] is not None), key = lambda x: x[1])
+	if windowLength is not None:
+		ret = [x for x in ret if x[1][1] - x[1][0] == windowLength]
+	if stepSize is not None and len(ret) > 0:
+		firstStart = ret[0][1][0]
+		ret = [x for x in ret if (x[1][0] - firstStart) % stepSize == 0]
+	return ret
+
+def _load_timeseries(index, scan, atlasobj):
+	"""
+	Load timeseries.csv of a scan as regions x time points.
+	"""
+	ts = loadsave.load_csvmat(index.bold_net_path(scan, atlasobj.name, 'timeseries.csv'))
+	if ts.shape[0] != atlasobj.count and ts.shape[1] == atlasobj.count:
+		ts = ts.T
+	return ts
+
+def _iter_timeseries_windows(index, scans, atlasobj, dynamicDict, dtype = np.float64):
+	"""
+	Compute the dynamic nets of each scan from its timeseries.csv.
+	Yields ((scan, window, name), mat) like the window files would give.
+	"""
+	windowLength = dynamicDict['windowLength']
+	stepSize = dynamicDict.get('stepSize', 1)
+	for scan in scans:
+		try:
+			ts = _load_timeseries(index, scan, atlasobj)
+		except FileNotFoundError as e:
+			logger.warning('File %s not found. %s', index.bold_net_path(scan, atlasobj.name, 'timeseries.csv'), e)
+			continue
+		with instrument_utils.timer('io.sliding_window_corrcoef', scan = scan, timeLength = ts.shape[1]):
+			mats = dynamic_utils.sliding_window_corrcoef(ts, windowLength, stepSize, dtype = dtype)
+		for start, mat in zip(dynamic_utils.window_starts(ts.shape[1], windowLength, stepSize), mats):
+			window = (int(start), int(start) + windowLength)
+			yield (scan, window, '%d-%d.csv' % window), mat
+
+def _prefetch(iterable, size):
+	"""
+	Run the iterable in a background thread, keeping up to size items ready.
+	"""
+	items = queue.Queue(maxsize = size)
+	stop = threading.Event()
+	done = object()
+	def produce():
+		try:
+			for item in iterable:
+				while not stop.is_set():
+					try:
+						items.put((item, None), timeout = 0.1)
+						break
+					except queue.Full:
+						pass
+				if stop.is_set():
+					return
+			items.put((done, None))
+		except BaseException as e:
+			items.put((done, e))
+	thread = threading.Thread(target = produce, daemon = True)
+	thread.start()
+	try:
+		while True:
+			item, error = items.get()
+			if item is done:
+				if error is not None:
+					raise error
+				return
+			yield item
+	finally:
+		stop.set()
+
+def _dynamic_labels(index, atlasobj, dynamicDict, timeCase, subjectList):
+	"""
+	The (scan, window) labels and paths of the dynamic nets to load.
+	"""
+	labels = []
+	paths = []
+	for scan in _select_time_case(index, timeCase, subjectList):
+		try:
+			for file, window in _dynamic_windows(index, scan, atlasobj.name, dynamicDict):
+				labels.append((scan, window))
+				paths.append(index.bold_net_path(scan, atlasobj.name, file))
+		except FileNotFoundError as e:
+			logger.warning('File %s not found. %s', index.bold_net_path(scan, atlasobj.name, 'corrcoef.csv'), e)
+	return labels, paths
+
+def iterAllDynamicNets(boldPath, atlasobj, dynamicDict, timeCase = 1, subjectList = None, batchSize = None, prefetch = 0, asCohort = False, workers = None, pool = 'thread', cache = None, fromTimeseries = False):
+	"""
+	Generator version of loadAllDynamicNets. The windows are loaded lazily, one batch at a time.
+	batchSize: None yields all windows of one scan per batch, an int yields fixed-size batches
+	prefetch: load up to this many batches ahead in a background thread
+	Each batch is a list of (scanName, (windowStart, windowEnd), net), or a
+	cohort_utils.NetCohort with scans and windows set if asCohort.
+	The window is None for files not named 'a-b.csv'.
+	fromTimeseries: compute the windows from timeseries.csv, see loadAllDynamicNets.
+	"""
+	subjectList = process_subject_list(subjectList, asSet = True)
+	index = get_scan_index(boldPath)
+	if fromTimeseries:
+		cohortArgs = asCohort if isinstance(asCohort, dict) else {}
+		stream = _iter_timeseries_windows(index, _select_time_case(index, timeCase, subjectList), atlasobj, dynamicDict, cohortArgs.get('dtype', np.float64))
+		if batchSize is None:
+			groups = (list(group) for scan, group in itertools.groupby(stream, key = lambda x: x[0][0]))
 		else:
-			# add all people in
-			retList += currentList
-	return retList
+			groups = iter(lambda: list(itertools.islice(stream, batchSize)), [])
+		batches = ((group, len(group)) for group in groups)
+		return _dynamic_batches(batches, atlasobj, asCohort, prefetch)
+	labels, paths = _dynamic_labels(index, atlasobj, dynamicDict, timeCase, subjectList)
+	# carry the file name along to name the nets, missing files are skipped by _iter_mats
+	labels = [(scan, window, os.path.basename(path)) for (scan, window), path in zip(labels, paths)]
+	batches = []
+	if batchSize is None:
+		start = 0
+		for idx in range(1, len(labels) + 1):
+			if idx == len(labels) or labels[idx][0] != labels[start][0]:
+				batches.append((start, idx))
+				start = idx
+	else:
+		batches = [(start, min(start + batchSize, len(labels))) for start in range(0, len(labels), batchSize)]
+	batches = ((_iter_mats(labels[start:end], paths[start:end], workers, pool, None, cache, atlasobj.name), end - start) for start, end in batches)
+	return _dynamic_batches(batches, atlasobj, asCohort, prefetch)
 
-def loadAllDynamicNets(boldPath, atlasobj, dynamicDict, timeCase = 1, subjectList = None):
+def _dynamic_batches(batches, atlasobj, asCohort, prefetch):
+	"""
+	Turn batches of ((scan, window, file), mat) into what iterAllDynamicNets yields.
+	"""
+	def load_batches():
+		for loaded, total in batches:
+			if asCohort:
+				yield _make_cohort(loaded, atlasobj, asCohort, total)
+			else:
+				yield [(scan, window, netattr.Net(mat, atlasobj, name = file)) for (scan, window, file), mat in loaded]
+	if prefetch:
+		return _prefetch(load_batches(), prefetch)
+	return load_batches()
+
+def loadAllDynamicNets(boldPath, atlasobj, dynamicDict, timeCase = 1, subjectList = None, asCohort = False, workers = None, pool = 'thread', timings = None, cache = None, fromTimeseries = False):
 	"""
 	This function loads all dynamic networks from the given subjects in the list
 	Only data from timeCase session are loaded
 	DynamicDict contains: 'windowLength' and 'stepSize', specified as integers
+	Only windows of this length and step are loaded, see _dynamic_windows.
+	The windows of a scan are in order of their start. A cohort carries the windows.
+	workers, pool, timings, cache: load in parallel, time each file and cache, see loadAllNets.
+	Use iterAllDynamicNets to load the windows lazily.
+	fromTimeseries: compute the windows from each scan's timeseries.csv with
+		dynamic_utils.sliding_window_corrcoef instead of reading one csv per window.
+		dynamicDict must give windowLength, stepSize defaults to 1.
+		workers, pool, timings and cache are not used then.
 	"""
-	subjectList = process_subject_list(subjectList)
-	ret = []
-	subjectName = 'None'
-	lastSubjectName = 'Unknown'
-	for scan in sorted(os.listdir(boldPath)):
-		if scan.find('_') != -1:
-			subjectName = scan[:scan.find('_')]
-		else:
-			subjectName = scan
-		if subjectName != lastSubjectName:
-			occurrenceCounter = 0
-			lastSubjectName = subjectName
-		occurrenceCounter += 1
-		if subjectList is not None and subjectName not in subjectList:
-			continue
-		if occurrenceCounter == timeCase:
-			try:
-				for file in sorted(os.listdir(os.path.join(boldPath, scan, atlasobj.name, 'bold_net'))):
-					if file.find('-') != -1:
-						ret.append(netattr.Net(loadsave.load_csvmat(os.path.join(boldPath, scan, atlasobj.name, 'bold_net', file)), atlasobj))
-			except FileNotFoundError as e:
-				print('File %s not found.' % os.path.join(boldPath, scan, atlasobj.name, 'bold_net', 'corrcoef.csv'))
-				print(e)
-	return ret
+	subjectList = process_subject_list(subjectList, asSet = True)
+	index = get_scan_index(boldPath)
+	if fromTimeseries:
+		cohortArgs = asCohort if isinstance(asCohort, dict) else {}
+		loaded = _iter_timeseries_windows(index, _select_time_case(index, timeCase, subjectList), atlasobj, dynamicDict, cohortArgs.get('dtype', np.float64))
+		if asCohort:
+			return _make_cohort(loaded, atlasobj, asCohort, None)
+		return [netattr.Net(mat, atlasobj) for label, mat in loaded]
+	labels, paths = _dynamic_labels(index, atlasobj, dynamicDict, timeCase, subjectList)
+	return _load(labels, paths, atlasobj, asCohort, workers, pool, timings, cache)
 
-def loadAllNets(boldPath, atlasobj, scanList = None):
+def loadAllNets(boldPath, atlasobj, scanList = None, asCohort = False, workers = None, pool = 'thread', timings = None, cache = None):
 	"""
 	This script is used to load all scans.
 	The given list contains scan names.
+	boldPath can be a ScanIndex to reuse one listing of the folder.
+	asCohort: return a cohort_utils.NetCohort instead of a list of nets.
+		Pass a dict like {'dtype': np.float32, 'packed': True} to control the storage.
+	workers: load with this many threads (or processes if pool = 'process').
+		The result keeps the sorted scan order.
+	timings: a list to collect per-file read/parse times, see summarize_load_timings.
+	cache: a cache_utils.MatrixCache. Each csv is parsed once and later read
+		back memory-mapped from its .npy copy. With asCohort, the whole stack is cached instead.
 	"""
-	scanList = process_subject_list(scanList)
-	ret = []
-	if scanList is None:
-		scanList = sorted(os.listdir(boldPath))
-	for scan in sorted(os.listdir(boldPath)):
-		if scan not in scanList:
+	scanList = process_subject_list(scanList, asSet = True)
+	index = get_scan_index(boldPath)
+	scans = [scan for scan in index.scans if scanList is None or scan in scanList]
+	paths = [index.bold_net_path(scan, atlasobj.name, 'corrcoef.csv') for scan in scans]
+	return _load(scans, paths, atlasobj, asCohort, workers, pool, timings, cache)
+
+def loadAllEdgeValues(boldPath, atlasobj, xidx, yidx, scanList = None, dynamicIncluded = False, dynamicDict = None, workers = None, pool = 'thread', cache = None):
+	"""
+	Read only the connections (xidx, yidx) of all scans, without building nets.
+	xidx, yidx: node index arrays of the K connections to read.
+	dynamicIncluded: also read the dynamic nets of each scan, selected by dynamicDict
+		as in loadAllDynamicNets.
+	cache: a cache_utils.MatrixCache. Cached matrices are memory-mapped,
+		so only the pages holding the requested connections are read.
+	Returns (labels, values): the (scan, window) of each row, window None for
+	the static corrcoef.csv, and a (rows, K) array.
+	"""
+	scanList = process_subject_list(scanList, asSet = True)
+	index = get_scan_index(boldPath)
+	xidx = np.asarray(xidx, dtype = int)
+	yidx = np.asarray(yidx, dtype = int)
+	labels = []
+	paths = []
+	for scan in index.scans:
+		if scanList is not None and scan not in scanList:
+			continue
+		labels.append((scan, None))
+		paths.append(index.bold_net_path(scan, atlasobj.name, 'corrcoef.csv'))
+		if not dynamicIncluded:
 			continue
 		try:
-			ret.append(netattr.Net(loadsave.load_csvmat(os.path.join(boldPath, scan, atlasobj.name, 'bold_net', 'corrcoef.csv')), atlasobj))
+			windows = _dynamic_windows(index, scan, atlasobj.name, dynamicDict)
 		except FileNotFoundError:
-			print('File %s not found.' % os.path.join(boldPath, scan, atlasobj.name, 'bold_net', 'corrcoef.csv'))
-	return ret
+			# reported as a missing corrcoef.csv already
+			continue
+		for file, window in windows:
+			labels.append((scan, window))
+			paths.append(index.bold_net_path(scan, atlasobj.name, file))
+	values = np.empty((len(paths), len(xidx)))
+	pathLabels = dict(zip(paths, labels))
+	loaded = []
+	for path, mat in _iter_mats(paths, paths, workers, pool, cache = cache, atlasName = atlasobj.name):
+		values[len(loaded)] = mat[xidx, yidx]
+		loaded.append(pathLabels[path])
+	return loaded, values[:len(loaded)]
 
 def save_matrix_csv_style(mat, filePath):
+	"""
+	Write the matrix as tab-separated '%f' values, one row per line,
+	without a newline after the last row. The whole text is formatted in
+	memory and written at once.
+	"""
 	xlim = mat.shape[0]
 	ylim = mat.shape[1]
-	xidx = 0
 	with open(filePath, 'w') as f:
-		while xidx < xlim:
-			yidx = 0
-			while yidx < ylim:
-				if yidx + 1 < ylim:
-					f.write('%f\t' % mat[xidx, yidx])
-				elif xidx + 1 < xlim:
-					f.write('%f\n' % mat[xidx, yidx])
-				else:
-					f.write('%f' % mat[xidx, yidx])
-				yidx += 1
-			xidx += 1
\ No newline at end of file
+		if xlim == 0 or ylim == 0:
+			return
+		rowFormat = '\t'.join(['%f'] * ylim)
+		f.write('\n'.join([rowFormat % tuple(row) for row in np.asarray(mat).tolist()]))
+
+def save_matrix(mat, filePath):
+	"""
+	Save a matrix according to the file extension:
+	.npy (numpy binary), .npz (compressed numpy, key 'mat') or else csv style.
+	"""
+	ext = os.path.splitext(filePath)[1]
+	if ext == '.npy':
+		np.save(filePath, mat)
+	elif ext == '.npz':
+		np.savez_compressed(filePath, mat = mat)
+	else:
+		save_matrix_csv_style(mat, filePath)
+
+def save_matrices(mats, outDir, names, fileType = 'csv', workers = None):
+	"""
+	Save a batch of matrices (a list, a stacked array or a cohort_utils.NetCohort)
+	as outDir/<name>.<fileType>, fileType is csv, npy or npz.
+	workers: write with this many threads.
+	"""
+	if isinstance(mats, cohort_utils.NetCohort):
+		mats = [mats.matrix(idx) for idx in range(len(mats))]
+	os.makedirs(outDir, exist_ok = True)
+	paths = [os.path.join(outDir, '%s.%s' % (name, fileType)) for name in names]
+	if workers is None or workers <= 1:
+		for mat, path in zip(mats, paths):
+			save_matrix(mat, path)
+		return paths
+	with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+		list(executor.map(save_matrix, mats, paths))
+	return paths
+
+def save_cohort(cohort, filePath, compressed = True):
+	"""
+	Save a whole cohort_utils.NetCohort with its metadata into one .npz file.
+	"""
+	arrays = {'data': cohort.data, 'scans': np.array(cohort.scans), 'subjects': np.array(cohort.subjects),
+		'times': np.array(cohort.times), 'packed': np.array(cohort.packed), 'atlas': np.array(cohort.atlasobj.name)}
+	if cohort.windows is not None:
+		arrays['windows'] = np.array(cohort.windows)
+	if compressed:
+		np.savez_compressed(filePath, **arrays)
+	else:
+		np.savez(filePath, **arrays)
+
+def load_cohort(filePath, atlasobj):
+	"""
+	Load a cohort saved by save_cohort.
+	"""
+	with np.load(filePath) as f:
+		windows = [tuple(window) for window in f['windows'].tolist()] if 'windows' in f else None
+		return cohort_utils.NetCohort(f['data'], atlasobj, scans = f['scans'].tolist(), subjects = f['subjects'].tolist(),
+			times = f['times'].tolist(), windows = windows, packed = bool(f['packed']))
@@ -0,0 +1,111 @@
+"""
+Lazy utils
+Deferred imports of the heavy dependencies (scipy, sklearn, statsmodels,
+matplotlib, mmdps), so that importing the utils stays fast and a job only
+pays for the libraries it actually uses.
+
+Set MMDPS_UTILS_IMPORT_REPORT=1 to print each deferred import and its time
+when it happens. Run
+	python lazy_utils.py io_utils stats_utils --budget 0.5
+to measure the import time of modules in a fresh interpreter, with
+python -X importtime; it exits with status 1 if a module is over budget.
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+import subprocess
+
+_reportImports = os.environ.get('MMDPS_UTILS_IMPORT_REPORT', '') not in ('', '0')
+
+class LazyModule:
+	"""
+	Stands in for a module until one of its attributes is used, then imports it.
+	Extra submodules (e.g. 'scipy.stats' for 'scipy') are imported along with it.
+	"""
+	def __init__(self, name, submodules = ()):
+		self.__dict__['_name'] = name
+		self.__dict__['_submodules'] = submodules
+		self.__dict__['_module'] = None
+
+	def _load(self):
+		module = self.__dict__['_module']
+		if module is None:
+			start = time.perf_counter()
+			module = importlib.import_module(self._name)
+			for submodule in self._submodules:
+				importlib.import_module(submodule)
+			self.__dict__['_module'] = module
+			if _reportImports:
+				print('Deferred import of %s took %1.3fs' % (', '.join((self._name,) + tuple(self._submodules)), time.perf_counter() - start), file = sys.stderr)
+		return module
+
+	def __getattr__(self, attr):
+		return getattr(self._load(), attr)
+
+	def __setattr__(self, attr, value):
+		setattr(self._load(), attr, value)
+
+	def __dir__(self):
+		return dir(self._load())
+
+	def __repr__(self):
+		if self.__dict__['_module'] is None:
+			return '<lazy module %s, not imported yet>' % self._name
+		return repr(self.__dict__['_module'])
+
+def lazy_import(name, *submodules):
+	"""
+	Return the module name, imported when first used.
+	Already imported modules are returned as is.
+	"""
+	if name in sys.modules and all(submodule in sys.modules for submodule in submodules):
+		return sys.modules[name]
+	return LazyModule(name, submodules)
+
+def import_time(moduleName, python = None):
+	"""
+	Import moduleName in a fresh interpreter with -X importtime.
+	Returns (total seconds, [(cumulative seconds, module)] of the direct and
+	nested imports, slowest first).
+	"""
+	python = python or sys.executable
+	result = subprocess.run([python, '-X', 'importtime', '-c', 'import %s' % moduleName],
+		cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True)
+	if result.returncode != 0:
+		raise ImportError('Importing %s failed:\n%s' % (moduleName, result.stderr.strip().splitlines()[-1]))
+	imports = []
+	total = None
+	for line in result.stderr.splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		self_us, cumulative_us, name = line[len('import time:'):].split('|')
+		if name.strip() == moduleName:
+			total = int(cumulative_us) / 1e6
+		imports.append((int(cumulative_us) / 1e6, name.rstrip()))
+	imports.sort(reverse = True)
+	return total, imports
+
+def import_report(moduleNames, budget = None, top = 10):
+	"""
+	Print the import time of each module and its slowest imports.
+	Returns True if all modules are within budget seconds.
+	"""
+	ok = True
+	for moduleName in moduleNames:
+		total, imports = import_time(moduleName)
+		overBudget = budget is not None and total > budget
+		ok = ok and not overBudget
+		print('%s: %1.3fs%s' % (moduleName, total, ' (over budget of %1.3fs)' % budget if overBudget else ''))
+		for cumulative, name in imports[1:top + 1]:
+			print('	%1.3fs %s' % (cumulative, name))
+	return ok
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Report the import time of the utils modules.')
+	parser.add_argument('modules', nargs = '*', default = ['io_utils', 'stats_utils', 'plot_utils', 'result_utils'])
+	parser.add_argument('--budget', type = float, default = None, help = 'seconds allowed per module')
+	parser.add_argument('--top', type = int, default = 10, help = 'number of slowest imports to list')
+	args = parser.parse_args()
+	sys.exit(0 if import_report(args.modules, args.budget, args.top) else 1)
@@ -1,41 +1,66 @@
-from matplotlib import cm
-from matplotlib import pyplot as plt
-from scipy import stats
 import numpy as np
 import copy
 
+import io_utils
+import atlas_utils
+import instrument_utils
+import lazy_utils
+
+cm = lazy_utils.lazy_import('matplotlib.cm')
+plt = lazy_utils.lazy_import('matplotlib.pyplot')
+
+_plotIndexCache = {}
+
+def get_plot_indexes(template, ticks):
+	"""
+	The permutation that puts a net with the given ticks into the plot order of the template.
+	Computed once per template and ticks, later calls get the cached array.
+	"""
+	key = (getattr(template, 'name', id(template)), tuple(ticks))
+	if key not in _plotIndexCache:
+		_plotIndexCache[key] = np.argsort(np.asarray(template.ticks_to_plot_indexes(ticks)), kind = 'stable')
+	return _plotIndexCache[key]
+
 def plot_heatmap_from_net(net, title, valuerange = (-1, 1)):
-	actual_plot_index = [i[0] for i in sorted(enumerate(net.template.ticks_to_plot_indexes(net.ticks)), key = lambda x:x[1])]
+	actual_plot_index = get_plot_indexes(net.template, net.ticks)
 	return plot_heatmap_order(net.net, net.template.ticks, actual_plot_index, title, valuerange)
 
+def reorder_matrix(mat, plotindexes):
+	"""
+	Reorder rows and columns of mat by plotindexes with one fancy-index operation.
+	mat can be one N x N matrix or a stack of them, (..., N, N).
+	"""
+	idx = np.asarray(plotindexes)
+	return mat[..., idx[:, np.newaxis], idx]
+
 def plot_heatmap_order(mat, xticks, plotindexes, title, valuerange = (-1, 1)):
 	"""
 	mat.shape[0] must equal len(xticks) and len(plotindexes).
 	plotindexes should be a permutation of range(len(xticks))
 	Here data order is adjusted.
 	"""
-	# TODO: optimize code here, use ndarray methods.
-	mat1 = np.empty(mat.shape)
-	mat2 = np.empty(mat.shape)
-	plot_ticks = [None] * len(xticks)
-	for i in range(len(plotindexes)):
-		realpos = plotindexes[i]
-		mat1[i, :] = mat[realpos, :]
-		plot_ticks[i] = xticks[realpos]
-	for i in range(len(plotindexes)):
-		realpos = plotindexes[i]
-		mat2[:, i] = mat1[:, realpos]
-	return plot_heatmap(mat2, plot_ticks, title, valuerange = valuerange)
+	plot_ticks = sub_list(xticks, plotindexes)
+	return plot_heatmap(reorder_matrix(mat, plotindexes), plot_ticks, title, valuerange = valuerange)
 
-def plot_heatmap(mat, xticks, title, valuerange = (-1, 1)):
+def plot_heatmap(mat, xticks, title, valuerange = (-1, 1), figsize = (20, 20)):
 	"""
 	actually plotting a mat using default orders and ticks.
 	"""
+	with instrument_utils.timer('plot.draw_heatmap', nodes = len(xticks)):
+		fig = plt.figure(figsize = figsize)
+		draw_heatmap(fig, mat, xticks, title, valuerange)
+	return fig
+
+def draw_heatmap(fig, mat, xticks, title, valuerange = (-1, 1)):
+	"""
+	Draw the heatmap of mat on fig through the object-oriented API, without pyplot state.
+	Returns the image and the title text, so a template figure can be reused
+	for another matrix of the same ticks with image.set_data and title.set_text.
+	"""
 	cmap = cm.terrain
-	fig = plt.figure(figsize = (20, 20))
-	axim = plt.imshow(mat, interpolation = 'none', cmap = cmap, vmin = valuerange[0], vmax = valuerange[1])
+	ax = fig.add_subplot(1, 1, 1)
+	axim = ax.imshow(mat, interpolation = 'none', cmap = cmap, vmin = valuerange[0], vmax = valuerange[1])
 	nrow, ncol = mat.shape
-	ax = fig.gca()
 	ax.set_xticks(range(len(xticks)))
 	ax.set_xticklabels(xticks, rotation = 90)
 	ax.set_yticks(range(len(xticks)))
@@ -43,26 +68,31 @@ def plot_heatmap(mat, xticks, title, valuerange = (-1, 1)):
 	
 	ax.set_xlim(-0.5, ncol-0.5)
 	ax.set_ylim(nrow-0.5, -0.5)
-	plt.title(title, fontsize = 30)
+	titleText = ax.set_title(title, fontsize = 30)
 	fig.colorbar(axim, fraction = 0.046, pad = 0.04)
-	return fig
+	return axim, titleText
+
+def draw_hist(fig, data, title, bins = 25, valuerange = (-1, 1), normalize = False, label = None):
+	"""
+	Draw a histogram of data on fig through the object-oriented API. Returns the bin heights.
+	"""
+	ax = fig.add_subplot(1, 1, 1)
+	n, bins, patches = ax.hist(data, bins = bins, range = valuerange, label = label, density = normalize)
+	ax.set_title(title)
+	return n
 
 def adjust_mat_col_order(mat, template):
-	mat1 = np.empty(mat.shape)
-	for i in range(template.count):
-		realpos = template.plotindexes[i]
-		mat1[:, i] = mat[:, realpos]
-	return mat1
+	"""
+	Reorder the columns of mat (or of each matrix in a stack) to the plot order of the template.
+	"""
+	return mat[..., np.asarray(template.plotindexes)]
 
 def sub_matrix(mat, idx):
 	npidx = np.array(idx)
 	return mat[npidx[:, np.newaxis], npidx]
 
 def sub_list(l, idx):
-	nl = []
-	for i in idx:
-		nl.append(l[i])
-	return nl
+	return [l[i] for i in idx]
 
 def generate_edge_file(nodeFilePath, edgeFilePath, edgeDict):
 	"""
@@ -84,10 +114,5 @@ def generate_edge_file(nodeFilePath, edgeFilePath, edgeDict):
 				nodeList.append('AR%d' % (counter + 8))
 			else:
 				nodeList.append(line[-1])
-	edgeMatrix = np.zeros((len(nodeList), len(nodeList)))
-	for edge in edgeDict:
-		xtick = edge.split('-')[0]
-		ytick = edge.split('-')[1]
-		edgeMatrix[nodeList.index(xtick), nodeList.index(ytick)] = edgeDict[edge]
-		edgeMatrix[nodeList.index(ytick), nodeList.index(xtick)] = edgeDict[edge]
+	edgeMatrix = atlas_utils.edge_dict_to_matrix(nodeList, edgeDict)
 	io_utils.save_matrix_csv_style(edgeMatrix, edgeFilePath)
@@ -2,8 +2,24 @@
 Result
 """
 import os, glob
+import time
+import concurrent.futures
 import numpy as np
-from matplotlib import pyplot as plt
+
+import logging
+
+import atlas_utils
+import instrument_utils
+import io_utils
+import lazy_utils
+import plot_utils
+import stats_utils
+
+plt = lazy_utils.lazy_import('matplotlib.pyplot')
+matplotlib = lazy_utils.lazy_import('matplotlib', 'matplotlib.figure', 'matplotlib.backends.backend_agg')
+atlas = lazy_utils.lazy_import('mmdps.proc.atlas')
+
+logger = logging.getLogger(__name__)
 
 # dynamic related
 def filter_DFCs(raw_dfcs, template_dfcs):
@@ -20,40 +36,187 @@ def filter_DFCs(raw_dfcs, template_dfcs):
 
 # heatmap, histogram related plotting
 def generate_net_heatmap(net, output_file, title):
-	fig = plot_utils.plot_heatmap_from_net(net, title)
-	os.makedirs(os.path.dirname(output_file), exist_ok = True)
-	plt.savefig(output_file)
-	plt.close()
+	with instrument_utils.timer('plot.render_figure', outputFile = output_file, figure = 'heatmap'):
+		fig = plot_utils.plot_heatmap_from_net(net, title)
+		os.makedirs(os.path.dirname(output_file), exist_ok = True)
+		fig.savefig(output_file)
+		plt.close(fig)
+	instrument_utils.count('plot.figures_rendered')
+
+# batch rendering, headless through the Agg canvas and the object-oriented Figure API
+_figureTemplates = {}
+
+def _template_figure(key, figsize, draw):
+	"""
+	Return the cached (fig, artists) for key, or create it with draw(fig).
+	Each worker process keeps its own few templates.
+	"""
+	if key not in _figureTemplates:
+		if len(_figureTemplates) >= 8:
+			_figureTemplates.clear()
+		fig = matplotlib.figure.Figure(figsize = figsize)
+		matplotlib.backends.backend_agg.FigureCanvasAgg(fig)
+		_figureTemplates[key] = (fig, draw(fig))
+		return _figureTemplates[key], True
+	return _figureTemplates[key], False
+
+def _save_figure(fig, outputFile, dpi, thumbnailDpi):
+	if os.path.dirname(outputFile):
+		os.makedirs(os.path.dirname(outputFile), exist_ok = True)
+	fig.savefig(outputFile, dpi = dpi)
+	if thumbnailDpi:
+		base, ext = os.path.splitext(outputFile)
+		fig.savefig('%s_thumb%s' % (base, ext), dpi = thumbnailDpi)
+
+def _render_heatmap(job):
+	"""
+	Render one heatmap. Figures with the same ticks reuse one template,
+	only the image data and title are replaced. Returns the render time.
+	"""
+	mat, ticks, title, outputFile, figsize, dpi, thumbnailDpi, valuerange = job
+	start = time.perf_counter()
+	key = ('heatmap', tuple(ticks), tuple(figsize), tuple(valuerange))
+	(fig, (image, titleText)), created = _template_figure(key, figsize, lambda fig: plot_utils.draw_heatmap(fig, mat, ticks, title, valuerange))
+	if not created:
+		image.set_data(mat)
+		titleText.set_text(title)
+	_save_figure(fig, outputFile, dpi, thumbnailDpi)
+	return time.perf_counter() - start
+
+def _render_hist(job):
+	"""
+	Render one histogram. Histograms with the same bins reuse one template,
+	only the bar heights and title are replaced. Returns the render time.
+	"""
+	data, title, outputFile, figsize, dpi, thumbnailDpi, bins, valuerange, normalize = job
+	start = time.perf_counter()
+	key = ('hist', tuple(figsize), bins, tuple(valuerange), normalize)
+	def draw(fig):
+		plot_utils.draw_hist(fig, data, title, bins, valuerange, normalize)
+		return fig.axes[0]
+	(fig, ax), created = _template_figure(key, figsize, draw)
+	if not created:
+		n, edges = np.histogram(data, bins = bins, range = valuerange, density = normalize)
+		for patch, height in zip(ax.patches, n):
+			patch.set_height(height)
+		ax.set_ylim(0, max(n.max(), 1e-12) * 1.05)
+		ax.set_title(title)
+	_save_figure(fig, outputFile, dpi, thumbnailDpi)
+	return time.perf_counter() - start
+
+def _render_all(renderer, jobs, workers):
+	"""
+	Run the render jobs, in a process pool if workers > 1.
+	Returns the render time of each figure and prints a summary.
+	"""
+	start = time.perf_counter()
+	if workers is None or workers <= 1:
+		times = [renderer(job) for job in jobs]
+	else:
+		chunksize = max(1, len(jobs) // (4 * workers))
+		with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+			times = list(executor.map(renderer, jobs, chunksize = chunksize))
+	if times:
+		logger.info('Rendered %d figures in %1.2fs, %1.3fs per figure on average.', len(times), time.perf_counter() - start, np.mean(times))
+	if instrument_utils.enabled:
+		# the workers may be other processes, so the parent emits their timings
+		for duration in times:
+			instrument_utils.emit('plot.render_figure', 'timer', duration = duration, figure = renderer.__name__[len('_render_'):])
+		instrument_utils.count('plot.figures_rendered', len(times), workers = workers)
+	return times
+
+def render_net_heatmaps(nets, outputFiles, titles, workers = None, dpi = 100, thumbnailDpi = None, figsize = (20, 20), valuerange = (-1, 1)):
+	"""
+	Render the heatmaps of many nets to outputFiles, in plot order of their atlas.
+	workers: render in this many processes
+	thumbnailDpi: also save a low resolution <name>_thumb copy for quick checks
+	Returns the render time of each figure in seconds.
+	"""
+	jobs = []
+	for net, outputFile, title in zip(nets, outputFiles, titles):
+		plotindexes = plot_utils.get_plot_indexes(net.atlasobj, net.ticks)
+		mat = plot_utils.reorder_matrix(net.data, plotindexes)
+		ticks = plot_utils.sub_list(net.atlasobj.ticks, plotindexes)
+		jobs.append((mat, ticks, title, outputFile, figsize, dpi, thumbnailDpi, valuerange))
+	return _render_all(_render_heatmap, jobs, workers)
+
+def render_FC_hists(dataList, outputFiles, titles, workers = None, dpi = 100, thumbnailDpi = None, figsize = (6.4, 4.8), bins = 25, valuerange = (-1, 1), normalize = True):
+	"""
+	Render a histogram of each list of FC values (e.g. getAllFCAtIdx of many edges,
+	or get_all_connection_values of many subjects) to outputFiles.
+	Arguments as in render_net_heatmaps. Returns the render time of each figure.
+	"""
+	jobs = [(data, title, outputFile, figsize, dpi, thumbnailDpi, bins, valuerange, normalize) for data, outputFile, title in zip(dataList, outputFiles, titles)]
+	return _render_all(_render_hist, jobs, workers)
 
 def getAllFCAtIdx(xidx, yidx, all_nets):
 	return [net.data[xidx, yidx] for net in all_nets]
 
-def getAllFCAtTick(xidx, yidx, all_nets, dynamicIncluded = False):
-	return [net.data[xidx, yidx] for net in all_nets]
+def _resolve_edges(atlasobj, xtick, ytick):
+	"""
+	Node index arrays of tick names (or node indexes), and whether a single connection was asked for.
+	"""
+	single = np.ndim(xtick) == 0
+	xticks = [xtick] if single else list(xtick)
+	yticks = [ytick] if single else list(ytick)
+	if len(xticks) > 0 and isinstance(xticks[0], str):
+		return atlas_utils.ticks_to_indexes(atlasobj, xticks), atlas_utils.ticks_to_indexes(atlasobj, yticks), single
+	return np.asarray(xticks, dtype = int), np.asarray(yticks, dtype = int), single
+
+def getAllFCAtTick(xtick, ytick, all_nets = None, template_name = None, boldPath = None, dynamicIncluded = False, cache = None, workers = None):
+	"""
+	Values of connection xtick-ytick for all nets.
+	xtick, ytick: tick names like 'L2' and 'R5', resolved through the atlas, or node indexes.
+		Lists of ticks read many connections at once.
+	all_nets: a list of nets or a cohort_utils.NetCohort.
+	Without all_nets, the values are read from the corrcoef.csv of every scan in boldPath,
+	for the atlas template_name, without building nets. dynamicIncluded also reads
+	the dynamic nets of every scan. cache (a cache_utils.MatrixCache) and workers
+	are passed to io_utils.loadAllEdgeValues.
+	Returns a list of values for one connection, or a (nets, connections) array.
+	"""
+	if all_nets is None:
+		atlasobj = atlas.get(template_name)
+		xidx, yidx, single = _resolve_edges(atlasobj, xtick, ytick)
+		labels, values = io_utils.loadAllEdgeValues(boldPath, atlasobj, xidx, yidx, dynamicIncluded = dynamicIncluded, workers = workers, cache = cache)
+	else:
+		atlasobj = all_nets.atlasobj if hasattr(all_nets, 'atlasobj') else all_nets[0].atlasobj
+		xidx, yidx, single = _resolve_edges(atlasobj, xtick, ytick)
+		if hasattr(all_nets, 'edge'):
+			values = all_nets.edge(xidx, yidx)
+		else:
+			values = np.array([net.data[xidx, yidx] for net in all_nets]).reshape(len(all_nets), len(xidx))
+	if single:
+		return values[:, 0].tolist()
+	return values
 
-def plot_FCHist_at_tick(xtick, ytick, all_nets = None, template_name = 'brodmann_lr_3', normalize = True, saveDir = None, show_img = False):
-	data = getAllFCAtTick(xtick, ytick, all_nets)
+def plot_FCHist_at_tick(xtick, ytick, all_nets = None, template_name = 'brodmann_lr_3', normalize = True, saveDir = None, show_img = False, boldPath = None, dynamicIncluded = False):
+	data = getAllFCAtTick(xtick, ytick, all_nets, template_name = template_name, boldPath = boldPath, dynamicIncluded = dynamicIncluded)
 	n, bins, patches = plt.hist(data, bins = 25, range = (-1, 1), density = normalize)
 	plt.title('fc hist %s-%s' % (xtick, ytick))
-	if saveDir:
-		os.makedirs(saveDir, exist_ok = True)
-		plt.savefig(os.path.join(saveDir, '%s-%s fc hist.png' % (xtick, ytick)))
-	if show_img:
-		plt.show()
-	else:
-		plt.close()
+	with instrument_utils.timer('plot.render_figure', figure = 'hist', saveDir = saveDir):
+		if saveDir:
+			os.makedirs(saveDir, exist_ok = True)
+			plt.savefig(os.path.join(saveDir, '%s-%s fc hist.png' % (xtick, ytick)))
+		if show_img:
+			plt.show()
+		else:
+			plt.close()
+	if saveDir or show_img:
+		instrument_utils.count('plot.figures_rendered')
 	return n
 
 def overlap_FCHists_at_tick(xtick, ytick, dataDict, normalize = False, saveDir = None, show_img = False):
 	"""
-	dataDict should be: {'Beijing':{'path':'/path/to/folder', 'template_name'}} or {'Beijing': {'net_list':[<rawnet1>, <rawnet2>, ...], 'template_name'}} or {'Beijing':{'value_list':[1, 2, 3, ...]}}
+	dataDict should be: {'Beijing':{'path':'/path/to/folder', 'template_name':'brodmann_lr_3', 'dynamicIncluded':False}} or {'Beijing': {'net_list':[<rawnet1>, <rawnet2>, ...]}} or {'Beijing':{'value_list':[1, 2, 3, ...]}}
+	'dynamicIncluded' is optional. A net_list can also be a cohort_utils.NetCohort.
 	The return value, n, is a list of lists. Each list contains the height of each bin. One can calculate the intersection by selecting the minimal value among lists.
 	"""
 	alpha_value = 1.0/len(dataDict)
 	heights = []
 	for name, dataValue in dataDict.items():
 		if 'path' in dataValue:
-			data = getAllFCAtTick(xtick, ytick, dataValue['template_name'], boldPath = dataValue['path'], dynamicIncluded = dynamicIncluded)
+			data = getAllFCAtTick(xtick, ytick, template_name = dataValue['template_name'], boldPath = dataValue['path'], dynamicIncluded = dataValue.get('dynamicIncluded', False))
 		elif 'net_list' in dataValue:
 			data = getAllFCAtTick(xtick, ytick, dataValue['net_list'])
 		else:
@@ -63,13 +226,16 @@ def overlap_FCHists_at_tick(xtick, ytick, dataDict, normalize = False, saveDir =
 	plt.legend(loc = 'upper right')
 	intersection_area = calculate_intersection_area(heights)
 	plt.title('Intersection: %1.3f %s-%s' % (intersection_area, xtick, ytick))
-	if saveDir:
-		os.makedirs(saveDir, exist_ok = True)
-		plt.savefig(os.path.join(saveDir, '%1.3f %s-%s fc hist.png' % (intersection_area, xtick, ytick)))
-	if show_img:
-		plt.show()
-	else:
-		plt.close()
+	with instrument_utils.timer('plot.render_figure', figure = 'hist', saveDir = saveDir):
+		if saveDir:
+			os.makedirs(saveDir, exist_ok = True)
+			plt.savefig(os.path.join(saveDir, '%1.3f %s-%s fc hist.png' % (intersection_area, xtick, ytick)))
+		if show_img:
+			plt.show()
+		else:
+			plt.close()
+	if saveDir or show_img:
+		instrument_utils.count('plot.figures_rendered')
 	return heights
 
 def calculate_intersection_area(heights):
@@ -79,10 +245,75 @@ def calculate_intersection_area(heights):
 	"""
 	num_bins = len(heights[0])
 	bin_width = 2.0/num_bins
-	intersection_area = 0.0
-	for bidx in range(num_bins):
-		intersection_area += bin_width * min([h[bidx] for h in heights])
-	return intersection_area
+	return bin_width * np.min(np.asarray(heights, dtype = float), axis = 0).sum()
+
+def edge_histograms(nets, bins = 25, valuerange = (-1, 1), normalize = False):
+	"""
+	Bin the values of every connection over all scans at once, without plotting.
+	nets: a NetCohort, a stacked (scans, N, N) array, a (scans, N*(N-1)/2) array of
+	upper-triangle connections or a list of nets.
+	Returns an (edges, bins) array of counts (or densities if normalize), in the
+	np.triu_indices order of the connections. Binning is the same as plt.hist
+	with the same bins and range, values out of range are not counted.
+	"""
+	edges = np.asarray(stats_utils.edge_values(nets))
+	instrument_utils.count('result.edges_binned', edges.size)
+	low, high = valuerange
+	edgeCount = edges.shape[1]
+	counts = np.zeros(edgeCount * bins, dtype = np.int64)
+	offsets = np.arange(edgeCount, dtype = np.int64) * bins
+	binEdges = np.linspace(low, high, bins + 1)
+	# one scan at a time keeps the temporary index arrays small
+	for values in edges:
+		inRange = (values >= low) & (values <= high)
+		with np.errstate(invalid = 'ignore'):
+			binIdx = np.floor((values - low) * (bins / (high - low))).astype(np.int64)
+		np.clip(binIdx, 0, bins - 1, out = binIdx)
+		# fix rounding at the bin edges, so values fall in the same bins as with np.histogram
+		binIdx -= values < binEdges[binIdx]
+		binIdx += (values >= binEdges[binIdx + 1]) & (binIdx != bins - 1)
+		counts += np.bincount((offsets + binIdx)[inRange], minlength = edgeCount * bins)
+	counts = counts.reshape(edgeCount, bins)
+	if not normalize:
+		return counts
+	totals = counts.sum(axis = 1, keepdims = True)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		return counts / (totals * ((high - low) / bins))
+
+def intersection_areas(heights, valuerange = (-1, 1)):
+	"""
+	Histogram intersection of every connection.
+	heights is a list of (edges, bins) arrays, one per group, as from edge_histograms.
+	Returns an (edges,) array. With normalized histograms 1.0 means identical distributions.
+	"""
+	heights = np.asarray(heights, dtype = float)
+	binWidth = (valuerange[1] - valuerange[0]) / heights.shape[-1]
+	return binWidth * np.min(heights, axis = 0).sum(axis = -1)
+
+def screen_FCHist_overlap(dataDict, bins = 25, valuerange = (-1, 1), normalize = True, plotTop = 0, saveDir = None):
+	"""
+	Compute the FC histogram intersection of every connection between groups,
+	e.g. {'Beijing': beijingCohort, 'Others': othersCohort}, without plotting.
+	Connections are sorted by intersection area, smallest (most different) first.
+	The plotTop first connections are plotted with overlap_FCHists_at_tick to saveDir.
+	Returns xidx, yidx, areas, and the dict of (edges, bins) histograms per group
+	(in the unsorted np.triu_indices order).
+	"""
+	heights = {name: edge_histograms(nets, bins, valuerange, normalize) for name, nets in dataDict.items()}
+	areas = intersection_areas(list(heights.values()), valuerange)
+	nodeCount = stats_utils.edge_count_to_node_count(len(areas))
+	xidx, yidx = np.triu_indices(nodeCount, 1)
+	order = np.argsort(areas, kind = 'stable')
+	if plotTop:
+		values = {name: np.asarray(stats_utils.edge_values(nets)) for name, nets in dataDict.items()}
+		atlasobj = getattr(next(iter(dataDict.values())), 'atlasobj', None)
+		for edge in order[:plotTop]:
+			if atlasobj is None:
+				xtick, ytick = str(xidx[edge]), str(yidx[edge])
+			else:
+				xtick, ytick = atlasobj.ticks[xidx[edge]], atlasobj.ticks[yidx[edge]]
+			overlap_FCHists_at_tick(xtick, ytick, {name: {'value_list': groupValues[:, edge]} for name, groupValues in values.items()}, normalize = normalize, saveDir = saveDir)
+	return xidx[order], yidx[order], areas[order], heights
 
 def intersect_FCHist_at_tick_dynamic_category(xtick, ytick, template_name, dataDict, normalize = False, saveDir = None, show_img = False):
 	"""
@@ -96,10 +327,13 @@ def plot_hist_per_subject(subjectName, subjectNet, normalize = False, saveDir =
 	"""
 	plt.hist(subjectNet.get_all_connection_values(), bins = 25, range = (-1, 1), label = subjectName, density = normalize)
 	plt.title(subjectName)
-	if saveDir:
-		os.makedirs(saveDir, exist_ok = True)
-		plt.savefig(os.path.join(saveDir, '%s fc hist.png' % (subjectName)))
-	if show_img:
-		plt.show()
-	else:
-		plt.close()
+	with instrument_utils.timer('plot.render_figure', figure = 'hist', saveDir = saveDir):
+		if saveDir:
+			os.makedirs(saveDir, exist_ok = True)
+			plt.savefig(os.path.join(saveDir, '%s fc hist.png' % (subjectName)))
+		if show_img:
+			plt.show()
+		else:
+			plt.close()
+	if saveDir or show_img:
+		instrument_utils.count('plot.figures_rendered')
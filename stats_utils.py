@@ -1,10 +1,22 @@
 """
 stats utils
 """
+import concurrent.futures
+import shutil
+import tempfile
+import logging
 import numpy as np
-import scipy, scipy.stats
-from sklearn import svm
-from statsmodels.stats import multitest
+
+import atlas_utils
+import instrument_utils
+import lazy_utils
+
+# heavy dependencies, imported on first use
+scipy = lazy_utils.lazy_import('scipy', 'scipy.stats', 'scipy.sparse', 'scipy.sparse.csgraph')
+sklearn = lazy_utils.lazy_import('sklearn', 'sklearn.base', 'sklearn.svm', 'sklearn.pipeline', 'sklearn.preprocessing', 'sklearn.model_selection')
+multitest = lazy_utils.lazy_import('statsmodels.stats.multitest')
+
+logger = logging.getLogger(__name__)
 
 def row_wise_ttest(net1, net2, sigLevel = 0.05):
 	"""
@@ -14,26 +26,88 @@ def row_wise_ttest(net1, net2, sigLevel = 0.05):
 	row in net2.
 	Note: the auto-correlation term is removed
 	"""
+	rows1 = _off_diagonal_rows(net1.data)[0]
+	rows2 = _off_diagonal_rows(net2.data)[0]
+	instrument_utils.count('stats.tests', rows1.shape[0], test = 'row_wise_ttest')
+	t, p = scipy.stats.ttest_ind(rows1, rows2, axis = 1)
 	sigRegion = np.zeros(net1.data.shape[0])
-	for rowIdx in range(net1.data.shape[0]):
-		row1 = np.delete(net1.data[rowIdx, :], rowIdx)
-		row2 = np.delete(net2.data[rowIdx, :], rowIdx)
-		t, p = twoSampleTTest(row1, row2)
-		if p < sigLevel:
-			sigRegion[rowIdx] = 1
+	sigRegion[p < sigLevel] = 1
 	return sigRegion
 
-def mean_confidence_interval(data, confidence = 0.95):
+def _off_diagonal_rows(nets):
+	"""
+	The rows of each net without the auto-correlation term, as a (subjects, N, N-1) array.
+	nets can be one N x N matrix, a stacked array, a list of nets or a cohort.
+	"""
+	mats = stack_nets(nets)
+	if mats.ndim == 2:
+		mats = mats[np.newaxis]
+	n = mats.shape[1]
+	return mats[:, ~np.eye(n, dtype = bool)].reshape(mats.shape[0], n, n - 1)
+
+def row_wise_ttest_groups(netListA, netListB, paired = False):
+	"""
+	Row-wise t-test of all regions at once, between two groups of nets.
+	Each subject contributes one value per region, the mean of its row
+	(without the auto-correlation term), and the t-test is across subjects,
+	so the connections of one subject are not taken as independent samples.
+	paired = True pairs the subjects of both groups (e.g. before/after treatment).
+	Returns t, p as 1-d arrays over the regions.
+	"""
+	meanA = _off_diagonal_rows(netListA).mean(axis = 2)
+	meanB = _off_diagonal_rows(netListB).mean(axis = 2)
+	instrument_utils.count('stats.tests', meanA.shape[1], test = 'row_wise_ttest_groups')
+	if paired:
+		return scipy.stats.ttest_rel(meanA, meanB, axis = 0)
+	return scipy.stats.ttest_ind(meanA, meanB, axis = 0)
+
+def mean_confidence_interval(data, confidence = 0.95, axis = None):
+	"""
+	Mean and its t-distribution confidence interval.
+	With axis, data is an array of samples along that axis, e.g. axis = 0 of
+	a (subjects, edges) array gives the intervals of all edges at once.
+	Returns m, lower, upper.
+	"""
 	a = 1.0 * np.array(data)
-	n = len(a)
-	m, se = np.mean(a), scipy.stats.sem(a)
+	if axis is None:
+		n = len(a)
+		m, se = np.mean(a), scipy.stats.sem(a)
+	else:
+		n = a.shape[axis]
+		m, se = np.mean(a, axis = axis), scipy.stats.sem(a, axis = axis)
 	h = se * scipy.stats.t.ppf((1+confidence)/2., n-1)
 	return m, m-h, m+h
 
+def bootstrap_confidence_interval(data, confidence = 0.95, axis = 0, nBoot = 1000, seed = None, memoryBudget = 256 * 2**20):
+	"""
+	Mean and its percentile bootstrap confidence interval along axis, for all
+	other positions of the array at once (e.g. every edge of a stacked cohort).
+	All positions share the same nBoot resamples of the samples, drawn with seed.
+	The resampled means are the product of the resample counts with the data,
+	computed for as many positions at a time as fit in memoryBudget bytes.
+	Returns m, lower, upper with the shape of data without axis.
+	"""
+	a = np.moveaxis(np.asarray(data, dtype = np.float64), axis, 0)
+	n = a.shape[0]
+	outShape = a.shape[1:]
+	a = a.reshape(n, -1)
+	rng = np.random.default_rng(seed)
+	weights = rng.multinomial(n, np.full(n, 1.0 / n), size = nBoot) / float(n)
+	alpha = (1 - confidence) / 2.
+	lower = np.empty(a.shape[1])
+	upper = np.empty(a.shape[1])
+	chunk = max(1, int(memoryBudget // (8 * nBoot)))
+	for start in range(0, a.shape[1], chunk):
+		boots = weights @ a[:, start:start + chunk]
+		lower[start:start + chunk], upper[start:start + chunk] = np.percentile(boots, [100 * alpha, 100 * (1 - alpha)], axis = 0)
+	m = a.mean(axis = 0)
+	return m.reshape(outShape), lower.reshape(outShape), upper.reshape(outShape)
+
 def twoSampleTTest(a, b):
 	"""
 	https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.ttest_ind.html
 	"""
+	instrument_utils.count('stats.tests', test = 'twoSampleTTest')
 	t, p = scipy.stats.ttest_ind(a, b)
 	return (t, p)
 
@@ -41,8 +115,69 @@ def pairedTTest(a, b):
 	"""
 	https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.ttest_rel.html
 	"""
+	instrument_utils.count('stats.tests', test = 'pairedTTest')
 	t, p = scipy.stats.ttest_rel(a, b)
 
+def stack_nets(nets):
+	"""
+	This helper function stacks the data of a list of nets into one
+	(subjects, N, N) array. An ndarray that is already stacked is returned as is,
+	and a cohort_utils.NetCohort gives its stacked array.
+	"""
+	if isinstance(nets, np.ndarray):
+		return nets
+	if hasattr(nets, 'stack'):
+		return nets.stack
+	return np.stack([net.data for net in nets])
+
+def edge_values(nets):
+	"""
+	Return the upper-triangle connections (without auto-connections) of
+	each net as a (subjects, N*(N-1)/2) array, in the same row-major order
+	as the xidx, yidx double loop.
+	A 2-d array is taken as edge values already.
+	"""
+	if hasattr(nets, 'edges'):
+		return nets.edges
+	if isinstance(nets, np.ndarray) and nets.ndim == 2:
+		return nets
+	mat = stack_nets(nets)
+	xidx, yidx = np.triu_indices(mat.shape[1], 1)
+	return mat[:, xidx, yidx]
+
+def edge_count_to_node_count(edgeCount):
+	"""
+	N for a given number of upper-triangle connections N*(N-1)/2
+	"""
+	return int(round((1 + np.sqrt(1 + 8 * edgeCount)) / 2))
+
+def edge_ttest(netListA, netListB, paired = False):
+	"""
+	This function performs t-test on every connection between two groups
+	in one batched call, instead of one scipy call per connection.
+	The two groups can be lists of nets, stacked (subjects, N, N) arrays
+	or cohort_utils.NetCohort.
+	Use paired = True for paired t-test (same subjects before/after treatment).
+	Returns xidx, yidx, t, p as 1-d arrays over all upper-triangle connections.
+	"""
+	edgesA = edge_values(netListA)
+	edgesB = edge_values(netListB)
+	xidx, yidx = np.triu_indices(edge_count_to_node_count(edgesA.shape[1]), 1)
+	with instrument_utils.timer('stats.edge_ttest', edges = len(xidx), subjects = edgesA.shape[0] + edgesB.shape[0], paired = paired):
+		if paired:
+			t, p = scipy.stats.ttest_rel(edgesA, edgesB, axis = 0)
+		else:
+			t, p = scipy.stats.ttest_ind(edgesA, edgesB, axis = 0)
+	instrument_utils.count('stats.tests', len(xidx), test = 'edge_ttest')
+	return xidx, yidx, t, p
+
+def _sigdiff_connections(netListA, netListB, sigLevel, paired = False):
+	xidx, yidx, t, p = edge_ttest(netListA, netListB, paired)
+	sigIdx = np.flatnonzero(p < sigLevel)
+	ret = [(int(xidx[idx]), int(yidx[idx]), t[idx], p[idx]) for idx in sigIdx]
+	logger.info('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f', len(ret), float(len(ret))/len(p), sigLevel)
+	return ret
+
 def filter_sigdiff_connections(netListA, netListB, sigLevel = 0.05):
 	"""
 	This function returns a list of significant different connections
@@ -51,21 +186,9 @@ def filter_sigdiff_connections(netListA, netListB, sigLevel = 0.05):
 	This function takes in two lists of networks, perform 2 sample t-test on each 
 	connections, and take out those that are significant.
 	A connection is represented by a 4-element-tuple of idx, t-val and p-val
+	Use edge_ttest to get the t/p values of all connections.
 	"""
-	ret = []
-	atlasobj = netListA[0].atlasobj
-	totalTests = 0
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			# perform t-test
-			t, p = scipy.stats.ttest_ind(
-				[a.data[xidx, yidx] for a in netListA], 
-				[b.data[xidx, yidx] for b in netListB])
-			totalTests += 1
-			if p < sigLevel:
-				ret.append((xidx, yidx, t, p))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
-	return ret
+	return _sigdiff_connections(netListA, netListB, sigLevel)
 
 def filter_sigdiff_connections_Bonferroni(netListA, netListB, sigLevel = 0.05):
 	"""
@@ -81,24 +204,11 @@ def filter_sigdiff_connections_FDR(netListA, netListB, sigLevel = 0.05):
 	"""
 	This function performs 2 sample t-test on each connection using BH FDR correction.
 	"""
-	ret = []
-	atlasobj = netListA[0].atlasobj
-	totalTests = 0
-	conn_p_list = [] # a list of tuples (xidx, yidx, 0.001) etc
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			# perform t-test
-			t, p = scipy.stats.ttest_ind(
-				[a.data[xidx, yidx] for a in netListA], 
-				[b.data[xidx, yidx] for b in netListB])
-			totalTests += 1
-			conn_p_list.append((xidx, yidx, p))
+	xidx, yidx, t, p = edge_ttest(netListA, netListB)
 	# FDR correction
-	reject, pvals_corrected, _, _ = multitest.multipletests([a[2] for a in conn_p_list], sigLevel, method = 'fdr_bh')
-	for idx in range(len(reject)):
-		if reject[idx]:
-			ret.append((conn_p_list[idx][0], conn_p_list[idx][1]))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
+	reject, pvals_corrected, _, _ = multitest.multipletests(p, sigLevel, method = 'fdr_bh')
+	ret = [(int(xidx[idx]), int(yidx[idx])) for idx in np.flatnonzero(reject)]
+	logger.info('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f', len(ret), float(len(ret))/len(p), sigLevel)
 	return ret
 
 def sigdiff_connections_after_treatment(netListA, netListB, sigLevel = 0.05):
@@ -109,19 +219,277 @@ def sigdiff_connections_after_treatment(netListA, netListB, sigLevel = 0.05):
 	difference in FC after treatment.
 	A connection is represented by a 4-element-tuple of idx, t-val and p-val
 	"""
+	return _sigdiff_connections(netListA, netListB, sigLevel, paired = True)
+
+def _tail_stat(t, tail):
+	if tail == 'greater':
+		return t
+	if tail == 'less':
+		return -t
+	return np.abs(t)
+
+def _permuted_tstats(edges, perms, nA, paired):
+	"""
+	t values of all edges for a batch of permutations, as a (perms, edges) array.
+	edges: (subjects, E) for two groups stacked A then B, or the (subjects, E)
+		A - B differences if paired.
+	perms: (perms, subjects) indicator of group A membership, or signs (+1/-1) if paired.
+	The group sums come out of one matrix product per batch.
+	"""
+	n = edges.shape[0]
+	if paired:
+		mean = (perms @ edges) / n
+		var = ((edges ** 2).sum(axis = 0) - n * mean ** 2) / (n - 1)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			return mean / np.sqrt(var / n)
+	nB = n - nA
+	sumA = perms @ edges
+	sumSqA = perms @ (edges ** 2)
+	sumB = edges.sum(axis = 0) - sumA
+	sumSqB = (edges ** 2).sum(axis = 0) - sumSqA
+	meanA = sumA / nA
+	meanB = sumB / nB
+	pooledVar = (sumSqA - nA * meanA ** 2 + sumSqB - nB * meanB ** 2) / (n - 2)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		return (meanA - meanB) / np.sqrt(pooledVar * (1.0 / nA + 1.0 / nB))
+
+def _max_component_sizes(stats, threshold, xidx, yidx, nodeCount):
+	"""
+	For each row of stats, the number of edges in the largest connected component
+	formed by the edges with stats > threshold.
+	"""
+	ret = np.zeros(stats.shape[0], dtype = int)
+	for idx in range(stats.shape[0]):
+		supra = np.flatnonzero(stats[idx] > threshold)
+		if len(supra) == 0:
+			continue
+		ret[idx] = _component_edges(supra, xidx, yidx, nodeCount)[1].max()
+	return ret
+
+def _component_edges(supra, xidx, yidx, nodeCount):
+	"""
+	Label the connected components of the given edges.
+	Returns the component label of each edge and the edge count of each component.
+	"""
+	graph = scipy.sparse.coo_matrix((np.ones(len(supra)), (xidx[supra], yidx[supra])), shape = (nodeCount, nodeCount))
+	ncomp, labels = scipy.sparse.csgraph.connected_components(graph, directed = False)
+	edgeLabels = labels[xidx[supra]]
+	return edgeLabels, np.bincount(edgeLabels, minlength = ncomp)
+
+_permutationData = None
+
+def _init_permutation_worker(data):
+	global _permutationData
+	_permutationData = data
+
+def _permutation_batch(seedSeq, batchSize, nA, paired, tail, threshold, data = None):
+	"""
+	Run one batch of permutations. Returns the max statistic of each permutation,
+	and the max NBS component size if a threshold is given.
+	In the process pool the data are set once per worker by _init_permutation_worker.
+	"""
+	if data is None:
+		data = _permutationData
+	edges, xidx, yidx, nodeCount = data
+	rng = np.random.default_rng(seedSeq)
+	n = edges.shape[0]
+	if paired:
+		perms = rng.choice([-1.0, 1.0], size = (batchSize, n))
+	else:
+		perms = np.zeros((batchSize, n))
+		order = rng.random((batchSize, n)).argsort(axis = 1)
+		np.put_along_axis(perms, order[:, :nA], 1.0, axis = 1)
+	stats = _tail_stat(_permuted_tstats(edges, perms, nA, paired), tail)
+	maxStats = np.nanmax(stats, axis = 1)
+	if threshold is None:
+		return maxStats, None
+	return maxStats, _max_component_sizes(stats, threshold, xidx, yidx, nodeCount)
+
+def _run_permutations(netListA, netListB, nPerm, paired, tail, threshold, seed, batchSize, workers):
+	"""
+	Observed t values and the null distributions of the max statistic
+	(and max component size) over nPerm permutations.
+	The permutations are split in batches, each with its own seed spawned from seed,
+	so the result does not depend on the number of workers.
+	"""
+	edgesA = edge_values(netListA)
+	edgesB = edge_values(netListB)
+	nodeCount = edge_count_to_node_count(edgesA.shape[1])
+	xidx, yidx, t, p = edge_ttest(edgesA, edgesB, paired)
+	if paired:
+		edges = edgesA - edgesB
+	else:
+		edges = np.concatenate([edgesA, edgesB])
+	nA = edgesA.shape[0]
+	data = (edges, xidx, yidx, nodeCount)
+	sizes = [batchSize] * (nPerm // batchSize)
+	if nPerm % batchSize:
+		sizes.append(nPerm % batchSize)
+	seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+	with instrument_utils.timer('stats.permutations', permutations = nPerm, edges = len(xidx), workers = workers, nbs = threshold is not None):
+		if workers is None or workers <= 1:
+			results = [_permutation_batch(seedSeq, size, nA, paired, tail, threshold, data) for seedSeq, size in zip(seeds, sizes)]
+		else:
+			with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = _init_permutation_worker, initargs = (data,)) as executor:
+				results = list(executor.map(_permutation_batch, seeds, sizes, *[[arg] * len(sizes) for arg in (nA, paired, tail, threshold)]))
+	instrument_utils.count('stats.tests', nPerm * len(xidx), test = 'permutation')
+	maxStats = np.concatenate([r[0] for r in results])
+	maxSizes = None if threshold is None else np.concatenate([r[1] for r in results])
+	return xidx, yidx, t, maxStats, maxSizes, nodeCount
+
+def permutation_test_edges(netListA, netListB, nPerm = 5000, paired = False, tail = 'two', seed = None, batchSize = 500, workers = None):
+	"""
+	This function performs t-test on every connection with family-wise error
+	correction by permutation (max statistic).
+	Group labels (or signs of the differences if paired) are permuted nPerm times,
+	the largest t of all connections in each permutation forms the null distribution.
+	tail: 'two' uses |t|, 'greater' tests A > B, 'less' tests A < B
+	seed: makes the result reproducible, independent of workers
+	workers: spread the permutation batches across this many processes
+	Returns xidx, yidx, t and the corrected p of all upper-triangle connections.
+	Connections with an undefined t (constant in both groups) get p = NaN.
+	"""
+	xidx, yidx, t, maxStats, maxSizes, nodeCount = _run_permutations(netListA, netListB, nPerm, paired, tail, None, seed, batchSize, workers)
+	observed = _tail_stat(t, tail)
+	# number of permutations with a max statistic at least as large as observed
+	exceed = len(maxStats) - np.searchsorted(np.sort(maxStats), observed, side = 'left')
+	pCorrected = (exceed + 1) / (len(maxStats) + 1.0)
+	# a connection constant in both groups has no t, it is never significant
+	pCorrected[np.isnan(observed)] = np.nan
+	return xidx, yidx, t, pCorrected
+
+def filter_sigdiff_connections_permutation(netListA, netListB, sigLevel = 0.05, **kwargs):
+	"""
+	This function performs 2 sample t-test on each connection with permutation
+	based family-wise error correction, see permutation_test_edges for kwargs.
+	A connection is represented by a 4-element-tuple of idx, t-val and corrected p-val
+	"""
+	xidx, yidx, t, p = permutation_test_edges(netListA, netListB, **kwargs)
+	ret = [(int(xidx[idx]), int(yidx[idx]), t[idx], p[idx]) for idx in np.flatnonzero(p < sigLevel)]
+	logger.info('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f', len(ret), float(len(ret))/len(p), sigLevel)
+	return ret
+
+def network_based_statistic(netListA, netListB, threshold = 3.0, nPerm = 5000, paired = False, tail = 'two', seed = None, batchSize = 500, workers = None):
+	"""
+	Network-based statistic (Zalesky et al. 2010).
+	Connections with t above threshold (|t| for tail = 'two') form components,
+	the size of a component is its number of connections. Each component is
+	tested against the largest component size found in each of nPerm permutations.
+	Other arguments as in permutation_test_edges.
+	Returns a list of components, largest first, each a tuple of
+	(list of (xidx, yidx, t), size, corrected p).
+	"""
+	xidx, yidx, t, maxStats, maxSizes, nodeCount = _run_permutations(netListA, netListB, nPerm, paired, tail, threshold, seed, batchSize, workers)
+	supra = np.flatnonzero(_tail_stat(t, tail) > threshold)
+	if len(supra) == 0:
+		return []
+	edgeLabels, sizes = _component_edges(supra, xidx, yidx, nodeCount)
 	ret = []
-	atlasobj = netListA[0].atlasobj
-	totalTests = 0
-	for xidx in range(atlasobj.count):
-		for yidx in range(xidx + 1, atlasobj.count):
-			# perform t-test
-			t, p = scipy.stats.ttest_rel(
-				[a.data[xidx, yidx] for a in netListA], 
-				[b.data[xidx, yidx] for b in netListB])
-			totalTests += 1
-			if p < sigLevel:
-				ret.append((xidx, yidx, t, p))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
+	for label in np.flatnonzero(sizes):
+		members = supra[edgeLabels == label]
+		p = (np.sum(maxSizes >= sizes[label]) + 1) / (len(maxSizes) + 1.0)
+		ret.append(([(int(xidx[idx]), int(yidx[idx]), t[idx]) for idx in members], int(sizes[label]), p))
+	ret.sort(key = lambda x: -x[1])
+	logger.info('NBS components: %d. Largest: %d connections, p = %1.4f', len(ret), ret[0][1], ret[0][2])
+	return ret
+
+def _sigdiff_edge_selector():
+	"""
+	The SigDiffEdgeSelector class. It subclasses sklearn classes, so it is
+	defined on first use, which keeps sklearn out of the import of this module.
+	"""
+	if 'SigDiffEdgeSelector' in globals():
+		return globals()['SigDiffEdgeSelector']
+	class SigDiffEdgeSelector(sklearn.base.BaseEstimator, sklearn.base.TransformerMixin):
+		"""
+		Select the connections that differ between the two classes of the training
+		data by 2 sample t-test, like filter_sigdiff_connections does for two groups.
+		Used inside each cross-validation fold, so the test fold never takes part
+		in choosing the connections.
+		sigLevel: keep connections with p < sigLevel
+		maxEdges: keep at most this many connections (smallest p first)
+		At least the single most significant connection is kept.
+		"""
+		def __init__(self, sigLevel = 0.05, maxEdges = None):
+			self.sigLevel = sigLevel
+			self.maxEdges = maxEdges
+
+		def fit(self, X, y):
+			classes = np.unique(y)
+			t, p = scipy.stats.ttest_ind(X[y == classes[0]], X[y == classes[1]], axis = 0)
+			p = np.where(np.isnan(p), 1.0, p)
+			order = np.argsort(p, kind = 'stable')
+			count = max(1, int(np.sum(p < self.sigLevel)))
+			if self.maxEdges is not None:
+				count = min(count, self.maxEdges)
+			self.support_ = np.sort(order[:count])
+			self.t_ = t
+			self.p_ = p
+			return self
+
+		def transform(self, X):
+			return X[:, self.support_]
+
+	SigDiffEdgeSelector.__qualname__ = 'SigDiffEdgeSelector'
+	globals()['SigDiffEdgeSelector'] = SigDiffEdgeSelector
+	return SigDiffEdgeSelector
+
+def __getattr__(name):
+	if name == 'SigDiffEdgeSelector':
+		return _sigdiff_edge_selector()
+	raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+def make_sigdiff_svm_pipeline(sigLevel = 0.05, C = 1.0, kernel = 'linear', memory = None):
+	"""
+	Pipeline of SigDiffEdgeSelector, standardization and sklearn.svm.SVC.
+	The input is the (subjects, N*(N-1)/2) upper-triangle connections, see edge_values.
+	memory: a folder to cache the fitted selector, so fits that only differ in C reuse the t-tests
+	"""
+	return sklearn.pipeline.Pipeline([
+		('select', _sigdiff_edge_selector()(sigLevel = sigLevel)),
+		('scale', sklearn.preprocessing.StandardScaler()),
+		('svm', sklearn.svm.SVC(kernel = kernel, C = C))], memory = memory)
+
+def classify_sigdiff_connections(netListA, netListB, sigLevels = (0.001, 0.01, 0.05), Cs = (0.1, 1.0, 10.0), kernel = 'linear', nFolds = 5, nInnerFolds = 3, seed = None, workers = None, cacheDir = None):
+	"""
+	Nested cross-validated SVM classification of two groups on their significantly
+	different connections.
+	The outer nFolds folds estimate the accuracy. Inside each outer training fold,
+	a grid search over sigLevels and Cs with nInnerFolds folds picks the parameters.
+	The connections are selected on the training part of every fold only.
+	workers: run folds and grid points in parallel on this many cores
+	cacheDir: where to cache the fitted selectors, a temporary folder by default
+	Returns a dict with the outer fold 'scores', the 'bestParams' of each fold
+	and the (xidx, yidx) 'selectedEdges' of each fold's final model.
+	"""
+	edgesA = edge_values(netListA)
+	edgesB = edge_values(netListB)
+	X = np.concatenate([edgesA, edgesB])
+	y = np.concatenate([np.zeros(edgesA.shape[0], dtype = int), np.ones(edgesB.shape[0], dtype = int)])
+	xidx, yidx = np.triu_indices(edge_count_to_node_count(X.shape[1]), 1)
+	tempDir = None
+	if cacheDir is None:
+		tempDir = tempfile.mkdtemp()
+		cacheDir = tempDir
+	with instrument_utils.timer('stats.classify_sigdiff_connections', subjects = X.shape[0], edges = X.shape[1], folds = nFolds, gridPoints = len(sigLevels) * len(Cs)):
+		try:
+			grid = sklearn.model_selection.GridSearchCV(
+				make_sigdiff_svm_pipeline(kernel = kernel, memory = cacheDir),
+				{'select__sigLevel': list(sigLevels), 'svm__C': list(Cs)},
+				cv = sklearn.model_selection.StratifiedKFold(nInnerFolds, shuffle = True, random_state = seed),
+				n_jobs = workers)
+			result = sklearn.model_selection.cross_validate(grid, X, y,
+				cv = sklearn.model_selection.StratifiedKFold(nFolds, shuffle = True, random_state = seed),
+				n_jobs = workers, return_estimator = True)
+		finally:
+			if tempDir is not None:
+				shutil.rmtree(tempDir, ignore_errors = True)
+	ret = {'scores': result['test_score'], 'bestParams': [], 'selectedEdges': []}
+	for estimator in result['estimator']:
+		support = estimator.best_estimator_.named_steps['select'].support_
+		ret['bestParams'].append(estimator.best_params_)
+		ret['selectedEdges'].append(list(zip(xidx[support].tolist(), yidx[support].tolist())))
+	logger.info('SVM accuracy: %1.4f +- %1.4f over %d folds', np.mean(ret['scores']), np.std(ret['scores']), nFolds)
 	return ret
 
 def get_sub_network_connections(sub_network_list, atlasobj):
@@ -129,11 +497,8 @@ def get_sub_network_connections(sub_network_list, atlasobj):
 	This function takes in a list of sub_network nodes and return all 
 	connections (without auto-connections) within the sub_network
 	"""
-	ret = []
-	for xnode in sub_network_list:
-		for ynode in sub_network_list:
-			ret.append((atlasobj.ticks.index(xnode), atlasobj.ticks.index(ynode)))
-	return ret
+	xidx, yidx = atlas_utils.sub_network_indexes(atlasobj, sub_network_list)
+	return list(zip(xidx.tolist(), yidx.tolist()))
 
 def filter_sigdiff_connections_old(netListA, netListB, sigLevel = 0.05):
 	"""
@@ -141,15 +506,9 @@ def filter_sigdiff_connections_old(netListA, netListB, sigLevel = 0.05):
 	connections, and take out those that are significant. 
 	The significant different connections are returned in a list of strings
 	"""
-	ret = []
 	ticks = netListA[0].ticks
-	totalTests = 0
-	for xidx in range(len(ticks)):
-		for yidx in range(xidx + 1, len(ticks)):
-			t, p = scipy.stats.ttest_ind([a.get_value_at_idx(xidx, yidx) for a in netListA], 
-				[b.get_value_at_idx(xidx, yidx) for b in netListB])
-			totalTests += 1
-			if p < sigLevel:
-				ret.append('%s-%s' % (ticks[xidx], ticks[yidx]))
-	print('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f' % (len(ret), float(len(ret))/totalTests, sigLevel))
+	xidx, yidx, t, p = edge_ttest(netListA, netListB)
+	sig = p < sigLevel
+	ret = atlas_utils.indexes_to_edge_names(ticks, xidx[sig], yidx[sig])
+	logger.info('SigDiff connections: %d. Discover rate: %1.4f with sigLevel: %1.4f', len(ret), float(len(ret))/len(p), sigLevel)
 	return ret